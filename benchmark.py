@@ -0,0 +1,190 @@
+"""Offline benchmark for the config pipeline.
+
+Replays synthetic chat histories built from the committed `Original-Configs.txt` / `conf-week.txt`
+through `V2RayExtractor` with a fake Telegram client, a stub resolver and a stub GeoIP reader, and
+times every stage separately. Nothing touches the network.
+
+    python benchmark.py --scales 1000,10000,100000 --output bench_results.json
+    python benchmark.py --scales 1000 --compare bench_results.json
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Any
+
+import main
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_FILES = [main.OUTPUT_ORIGINAL_CONFIGS, main.WEEKLY_FILE]
+CHATTER = ["سلام", "Free config 🔥", "update soon", "join @channel", "ping?", "✅ tested"]
+
+
+class FakeChatClient:
+    """Stands in for `pyrogram.Client`: serves pre-built histories newest first."""
+    def __init__(self, histories: Dict[Any, List[SimpleNamespace]]):
+        self.histories = histories
+
+    async def __aenter__(self): return self
+    async def __aexit__(self, *exc): return False
+
+    async def get_dialogs(self):
+        for chat_id in self.histories: yield SimpleNamespace(chat=SimpleNamespace(id=chat_id))
+
+    async def get_chat_history(self, chat_id, limit: int = 0):
+        for msg in self.histories.get(chat_id, [])[:limit or None]: yield msg
+
+
+class StubGeoIP:
+    """Deterministic `geoip2.database.Reader` replacement keyed on the address hash."""
+    ISOS = ['US', 'GB', 'NL', 'FR', 'DE', 'FI', 'TR', 'IR', 'SG', None]
+
+    def country(self, addr: str):
+        iso = self.ISOS[hashlib.md5(addr.encode()).digest()[0] % len(self.ISOS)]
+        return SimpleNamespace(country=SimpleNamespace(iso_code=iso))
+
+
+async def stub_resolver(host: str):
+    d = hashlib.md5(host.encode()).digest()
+    if d[5] < 25: return None
+    return f"{d[0] % 223 + 1}.{d[1]}.{d[2]}.{d[3]}"
+
+
+def load_corpus() -> List[str]:
+    links = []
+    for name in CORPUS_FILES:
+        path = os.path.join(REPO_DIR, name)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f: links.extend(l.strip() for l in f if l.strip())
+    return links
+
+
+def make_message(msg_id: int, date: datetime.datetime, links: List[str], rng: random.Random) -> SimpleNamespace:
+    kind = rng.random()
+    entities = None
+    if not links: text = " ".join(rng.choices(CHATTER, k=rng.randint(1, 12)))
+    elif kind < 0.5: text = f"{rng.choice(CHATTER)}\n\n" + "\n\n".join(links)
+    elif kind < 0.7:
+        body = "\n".join(links); text = f"{rng.choice(CHATTER)}\n{body}"
+        entities = [SimpleNamespace(type=SimpleNamespace(name='CODE'), offset=len(text) - len(body), length=len(body))]
+    else: text = "sub:\n" + base64.b64encode("\n".join(links).encode()).decode()
+    return SimpleNamespace(id=msg_id, date=date, text=text, caption=None, entities=entities)
+
+
+def build_histories(corpus: List[str], messages: int, per_chat: int, seed: int = 1) -> Dict[Any, List[SimpleNamespace]]:
+    rng = random.Random(seed); now = datetime.datetime.now()
+    histories: Dict[Any, List[SimpleNamespace]] = {}
+    for n in range(messages):
+        chat_id = -1000000000000 - n // per_chat
+        links = rng.sample(corpus, k=min(len(corpus), rng.choice([0, 0, 1, 1, 2, 5])))
+        date = now - datetime.timedelta(minutes=n % per_chat)
+        histories.setdefault(chat_id, []).append(make_message(per_chat - n % per_chat, date, links, rng))
+    return histories
+
+
+def timed(stages: Dict[str, float], name: str):
+    class _Timer:
+        def __enter__(self): self.t = time.perf_counter()
+        def __exit__(self, *exc): stages[name] = round(time.perf_counter() - self.t, 6)
+    return _Timer()
+
+
+async def run_scale(messages: int, corpus: List[str], per_chat: int, max_per_source: int) -> Dict[str, Any]:
+    main.MAX_CONFIGS_PER_SOURCE = max_per_source
+    histories = build_histories(corpus, messages, per_chat)
+    ext = main.V2RayExtractor(resolver=stub_resolver, client=FakeChatClient(histories))
+    ext.limiter = main.TokenBucket(0); ext.prober = None
+    stages: Dict[str, float] = {}
+    all_msgs = [m for h in histories.values() for m in h]
+
+    with timed(stages, 'extraction'):
+        for m in all_msgs: main.extract_message_links(m)
+    with timed(stages, 'fetch'):
+        await ext.fetch_all([(chat_id, per_chat) for chat_id in histories], main.FetchScheduler(ext.limiter, deadline=3600))
+    valid = sorted(ext.valid_configs())
+    ext._records.clear()
+    with timed(stages, 'parsing'):
+        records = [(u, r) for u, r in zip(valid, ext.parse_batch(valid, workers=1)) if r]
+    # The same batch forced through the worker pool (startup included on the first scale), to see where it wins
+    ext._records.clear()
+    with timed(stages, 'parsing_pool'):
+        ext.parse_batch(valid, pool_min=0)
+    servers = [r.server for _, r in records if isinstance(r.server, str)]
+    with timed(stages, 'is_clean_ip'):
+        clean = main.BLOCKED_INDEX.classify(servers)
+    with timed(stages, 'enrichment'):
+        await ext.enrich_hosts(servers)
+    named = [(f"Config_jo-{i:02d}", u, r) for i, (u, r) in enumerate(records, 1)]
+    with timed(stages, 'retention'):
+        ext.handle_no_cf_retention([(f"{u.split('#')[0]}#{n}", r) for n, u, r in named if clean.get(r.server)])
+        ext.handle_weekly_file([(f"{u.split('#')[0]}#{n}", r) for n, u, r in named])
+        ext.handle_country_retention({'US': [(f"{u.split('#')[0]}#{n}", r) for n, u, r in named if ext.get_country_iso_code(r.server) == 'US']})
+        ext.retention.close(); ext._retention = None
+    with timed(stages, 'emission'):
+        ext.render_clash([(n, r) for n, _, r in named]); ext.render_sing_box([(n, r) for n, _, r in named])
+    ext._records.clear(); ext._country_cache.clear(); ext._dns_cache.clear()
+    with timed(stages, 'save_files'):
+        await ext.prepare(); ext.save_files()
+    return {'messages': messages, 'chats': len(histories), 'links': len(valid), 'parsed': len(records), 'workers': main.PARSE_WORKERS, 'stages': stages}
+
+
+def git_commit() -> str:
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError: return ""
+
+
+def compare(current: Dict[str, Any], baseline_path: str):
+    with open(baseline_path, 'r') as f: baseline = {r['messages']: r for r in json.load(f)['results']}
+    for res in current['results']:
+        if not (old := baseline.get(res['messages'])): continue
+        print(f"📊 {res['messages']} messages vs {baseline_path}:")
+        for stage, sec in res['stages'].items():
+            prev = old['stages'].get(stage)
+            if prev: print(f"   {stage:<12} {prev:>9.4f}s -> {sec:>9.4f}s  ({sec / prev:.2f}x)")
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description="Offline benchmark for the config pipeline.")
+    ap.add_argument('--scales', default='1000,10000', help="comma separated message counts")
+    ap.add_argument('--per-chat', type=int, default=main.GROUP_SEARCH_LIMIT, help="messages per synthetic chat")
+    ap.add_argument('--max-per-source', type=int, default=main.MAX_CONFIGS_PER_SOURCE)
+    ap.add_argument('--output', default='bench_results.json')
+    ap.add_argument('--compare', help="earlier results file to compare against")
+    args = ap.parse_args()
+
+    corpus = load_corpus()
+    if not corpus: sys.exit("❌ No corpus found (Original-Configs.txt / conf-week.txt).")
+    output = os.path.abspath(args.output); baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix='configjo-bench-'); cwd = os.getcwd()
+    results = []
+    try:
+        shutil.copy(os.path.join(REPO_DIR, main.BLOCKED_IPS_FILE), workdir)
+        os.chdir(workdir)
+        main.load_blocked_ips(); main.GEOIP_READER = StubGeoIP()
+        for scale in (int(x) for x in args.scales.split(',') if x.strip()):
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                res = asyncio.run(run_scale(scale, corpus, args.per_chat, args.max_per_source))
+            results.append(res)
+            print(f"⏱️ {scale} messages / {res['chats']} chats / {res['links']} links: " + ", ".join(f"{k}={v:.3f}s" for k, v in res['stages'].items()))
+    finally:
+        os.chdir(cwd); shutil.rmtree(workdir, ignore_errors=True)
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'timestamp': datetime.datetime.now().isoformat(), 'results': results}
+    if baseline: compare(report, baseline)
+    with open(output, 'w') as f: json.dump(report, f, indent=2)
+    print(f"✅ Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,17 +1,25 @@
 import re
+import argparse
 import asyncio
 import base64
 import json
-import yaml
 import os
 import datetime
 import ipaddress
 import socket
-import geoip2.database
+import bisect
+import hashlib
+import time
+import sqlite3
+import ssl
+import contextlib
+import atexit
+import multiprocessing
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs, unquote, urlunparse
-from pyrogram import Client, enums
-from pyrogram.errors import FloodWait
-from typing import Optional, Dict, Any, Set, List
+from typing import Optional, Dict, Any, Set, List, Tuple, Callable, Awaitable, Iterable
 
 # =================================================================================
 # Settings and Constants
@@ -31,24 +39,82 @@ OUTPUT_JSON_CONFIG_JO = "Config_jo.json"
 OUTPUT_ORIGINAL_CONFIGS = "Original-Configs.txt"
 OUTPUT_NO_CF = "Config_no_cf.txt"
 OUTPUT_LIGHT = "Config_jo_Light.txt"
+# sha256 and size of every published output; a write whose hash matches is skipped
+OUTPUT_MANIFEST = "manifest.json"
+EMIT_WORKERS = int(os.environ.get('EMIT_WORKERS', 4))
 
 LIGHT_MAX_AGE_HOURS = 1
 
 WEEKLY_FILE = "conf-week.txt"
-HISTORY_FILE = "conf-week-history.json"
 GEOIP_DATABASE_PATH = 'dbip-country-lite.mmdb'
-NO_CF_HISTORY_FILE = "no_cf_history.json"
+# Retention keys are endpoint fingerprints (`ProxyRecord.dedup_key`); rows keyed the old way are rekeyed once
+RETENTION_KEY_SCHEME = "endpoint-v2"
+PROTOCOL_ALIASES = {'hy2': 'hysteria2', 'shadowsocks': 'ss'}
 BLOCKED_IPS_FILE = "blocked_ips.txt"
+BLOCKED_IPS_INDEX_FILE = "blocked_ips.idx.json"
+
+# Private run state (chat ids, watermarks) lives outside the published outputs
+STATE_DIR = os.environ.get('STATE_DIR', '.state')
+CHAT_STATE_FILE = os.path.join(STATE_DIR, "chat_state.json")
+PEER_CACHE_FILE = os.path.join(STATE_DIR, "peer_cache.json")
+GEOIP_CACHE_FILE = os.path.join(STATE_DIR, "geoip_cache.json")
+# Cached with the rest of the run state, not committed; an empty store is refilled from the published exports
+RETENTION_DB = os.path.join(STATE_DIR, "retention.db")
+GEOIP_CACHE_TTL_HOURS = float(os.environ.get('GEOIP_CACHE_TTL_HOURS', 24))
+# Countries that get a regions/conf-XX.txt subscription: "*" for every country seen, or a list such as "US,UK,DE"
+REGION_COUNTRIES = {c.strip().upper() for c in os.environ.get('REGION_COUNTRIES', '*').split(',') if c.strip()}
+# Set to "" to disable the run report; RUN_REPORT_PROM additionally writes a Prometheus textfile
+RUN_REPORT_FILE = os.environ.get('RUN_REPORT_FILE', os.path.join(STATE_DIR, "run_report.json"))
+RUN_REPORT_PROM = os.environ.get('RUN_REPORT_PROM', "")
+
+DNS_CONCURRENCY = int(os.environ.get('DNS_CONCURRENCY', 50))
+DNS_TIMEOUT = float(os.environ.get('DNS_TIMEOUT', 3))
 
 CHANNEL_MAX_INACTIVE_DAYS = 4
 MAX_CONFIGS_PER_SOURCE = 20
 
-V2RAY_PATTERNS = [
-    re.compile(r'(vless:\/\/[^\s\'\"<>`|()\[\]{}]+)'), re.compile(r'(vmess:\/\/[^\s\'\"<>`|()\[\]{}]+)'),
-    re.compile(r'(trojan:\/\/[^\s\'\"<>`|()\[\]{}]+)'), re.compile(r'(ss:\/\/[^\s\'\"<>`|()\[\]{}]+)'),
-    re.compile(r"(hy2://[^\s'\"<>`|()\[\]{}]+)"), re.compile(r"(hysteria2://[^\s'\"<>`|()\[\]{}]+)"),
-    re.compile(r"(tuic://[^\s'\"<>`|()\[\]{}]+)")
-]
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', 4))
+FETCH_RATE = float(os.environ.get('FETCH_RATE', 2))
+FETCH_MAX_RETRIES = int(os.environ.get('FETCH_MAX_RETRIES', 3))
+FETCH_BACKOFF_CAP = float(os.environ.get('FETCH_BACKOFF_CAP', 60))
+FETCH_DEADLINE_SECONDS = float(os.environ.get('FETCH_DEADLINE_SECONDS', 1200))
+
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', os.cpu_count() or 1))
+PARSE_POOL_MIN = int(os.environ.get('PARSE_POOL_MIN', 50000))
+PARSE_CHUNK_SIZE = int(os.environ.get('PARSE_CHUNK_SIZE', 500))
+
+STREAM_PIPELINE = os.environ.get('STREAM_PIPELINE', '1') == '1'
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', 500))
+STREAM_WORKERS = int(os.environ.get('STREAM_WORKERS', DNS_CONCURRENCY))
+
+# `serve` mode: flush once updates have been quiet for the debounce, at the latest after the max delay,
+# and at least every interval so the Light window and the probes move on without new messages
+SERVE_DEBOUNCE_SECONDS = float(os.environ.get('SERVE_DEBOUNCE_SECONDS', 20))
+SERVE_MAX_DELAY_SECONDS = float(os.environ.get('SERVE_MAX_DELAY_SECONDS', 120))
+SERVE_FLUSH_INTERVAL = float(os.environ.get('SERVE_FLUSH_INTERVAL', 900))
+SERVE_PROBE_INTERVAL = float(os.environ.get('SERVE_PROBE_INTERVAL', 3600))
+
+# Reachability probing: TCP connect (plus TLS handshake for TLS transports) to every server:port
+PROBE_ENABLED = os.environ.get('PROBE_ENABLED', '1') == '1'
+PROBE_CONCURRENCY = int(os.environ.get('PROBE_CONCURRENCY', 100))
+PROBE_TIMEOUT = float(os.environ.get('PROBE_TIMEOUT', 3))
+PROBE_HISTORY_SIZE = int(os.environ.get('PROBE_HISTORY_SIZE', 8))
+PROBE_HISTORY_FILE = os.path.join(STATE_DIR, "probe_history.json")
+# Drop an endpoint from the client outputs once its last N probes all failed (0 keeps everything)
+PROBE_DROP_AFTER = int(os.environ.get('PROBE_DROP_AFTER', 3))
+# Order Clash / sing-box proxies by median latency, and keep only the N fastest per output (0 = no cap)
+PROBE_SORT = os.environ.get('PROBE_SORT', '0') == '1'
+PROBE_MAX_PER_OUTPUT = int(os.environ.get('PROBE_MAX_PER_OUTPUT', 0))
+# QUIC based protocols cannot be checked with a TCP connect
+PROBE_SKIP_TYPES = {'hysteria2', 'tuic'}
+# Loopback servers are normally junk; tests running local listeners switch the filter off
+ALLOW_LOOPBACK = os.environ.get('ALLOW_LOOPBACK', '0') == '1'
+
+# One alternation over every scheme: each text fragment is scanned once. Links may overlap (a
+# "vless://" glued onto the end of another link is still found), but a scheme token is never
+# matched inside another one, so "vless://" and "vmess://" no longer also yield a bogus "ss://".
+V2RAY_PATTERN = re.compile(r"(?:vless|vmess|trojan|hysteria2|hy2|tuic|ss)://")
+LINK_BODY_PATTERN = re.compile(r"[^\s'\"<>`|()\[\]{}]+")
 BASE64_PATTERN = re.compile(r"([A-Za-z0-9+/=]{50,})", re.MULTILINE)
 
 SS_VALID_CIPHERS = {
@@ -64,35 +130,650 @@ SS_VALID_CIPHERS = {
 COUNTRY_FLAGS = {'AD': '🇦🇩', 'AE': '🇦🇪', 'AF': '🇦🇫', 'AG': '🇦🇬', 'AI': '🇦🇮', 'AL': '🇦🇱', 'AM': '🇦🇲', 'AO': '🇦🇴', 'AQ': '🇦🇶', 'AR': '🇦🇷', 'AS': '🇦🇸', 'AT': '🇦🇹', 'AU': '🇦🇺', 'AW': '🇦🇼', 'AX': '🇦🇽', 'AZ': '🇦🇿', 'BA': '🇧🇦', 'BB': '🇧🇧', 'BD': '🇧🇩', 'BE': '🇧🇪', 'BF': '🇧🇫', 'BG': '🇧🇬', 'BH': '🇧🇭', 'BI': '🇧🇮', 'BJ': '🇧🇯', 'BL': '🇧🇱', 'BM': '🇧🇲', 'BN': '🇧🇳', 'BO': '🇧🇴', 'BR': '🇧🇷', 'BS': '🇧🇸', 'BT': '🇧🇹', 'BW': '🇧🇼', 'BY': '🇧🇾', 'BZ': '🇧🇿', 'CA': '🇨🇦', 'CC': '🇨🇨', 'CD': '🇨🇩', 'CF': '🇨🇫', 'CG': '🇨🇬', 'CH': '🇨🇭', 'CI': '🇨🇮', 'CK': '🇨🇰', 'CL': '🇨🇱', 'CM': '🇨🇲', 'CN': '🇨🇳', 'CO': '🇨🇴', 'CR': '🇨🇷', 'CU': '🇨🇺', 'CV': '🇨🇻', 'CW': '🇨🇼', 'CX': '🇨🇽', 'CY': '🇨🇾', 'CZ': '🇨🇿', 'DE': '🇩🇪', 'DJ': '🇩🇯', 'DK': '🇩🇰', 'DM': '🇩🇲', 'DO': '🇩🇴', 'DZ': '🇩🇿', 'EC': '🇪🇨', 'EE': '🇪🇪', 'EG': '🇪🇬', 'EH': '🇪🇭', 'ER': '🇪🇷', 'ES': '🇪🇸', 'ET': '🇪🇹', 'FI': '🇫🇮', 'FJ': '🇫🇯', 'FK': '🇫🇰', 'FM': '🇫🇲', 'FO': '🇫🇴', 'FR': '🇫🇷', 'GA': '🇬🇦', 'GB': '🇬🇬', 'GD': '🇬🇩', 'GE': '🇬🇪', 'GF': '🇬🇫', 'GG': '🇬🇬', 'GH': '🇬🇭', 'GI': '🇬🇮', 'GL': '🇬🇱', 'GM': '🇬🇲', 'GN': '🇬🇳', 'GP': '🇬🇵', 'GQ': '🇬🇶', 'GR': '🇬🇷', 'GT': '🇬🇹', 'GU': '🇬🇺', 'GW': '🇬🇼', 'GY': '🇬🇾', 'HK': '🇭🇰', 'HN': '🇭🇳', 'HR': '🇭🇷', 'HT': '🇭🇹', 'HU': '🇭🇺', 'ID': '🇮🇩', 'IE': '🇮🇪', 'IL': '🇮🇱', 'IM': '🇮🇲', 'IN': '🇮🇳', 'IO': '🇮🇴', 'IQ': '🇮🇶', 'IR': '🇮🇷', 'IS': '🇮🇸', 'IT': '🇮🇹', 'JE': '🇯🇪', 'JM': '🇯🇲', 'JO': '🇯🇴', 'JP': '🇯🇵', 'KE': '🇰🇪', 'KG': '🇰🇬', 'KH': '🇰🇭', 'KI': '🇰🇮', 'KM': '🇰🇲', 'KN': '🇰🇳', 'KP': '🇰🇵', 'KR': '🇰🇷', 'KW': '🇰🇼', 'KY': '🇰🇾', 'KZ': '🇰🇿', 'LA': '🇱🇦', 'LB': '🇱🇧', 'LC': '🇱🇨', 'LI': '🇱🇮', 'LK': '🇱🇰', 'LR': '🇱🇷', 'LS': '🇱🇸', 'LT': '🇱🇹', 'LU': '🇱🇺', 'LV': '🇱🇻', 'LY': '🇱🇾', 'MA': '🇲🇦', 'MC': '🇲🇨', 'MD': '🇲🇩', 'ME': '🇲🇪', 'MF': '🇲🇫', 'MG': '🇲🇬', 'MH': '🇲🇭', 'MK': '🇲🇰', 'ML': '🇲🇱', 'MM': '🇲🇲', 'MN': '🇲🇳', 'MO': '🇲🇴', 'MP': '🇲🇵', 'MQ': '🇲🇶', 'MR': '🇲🇷', 'MS': '🇲🇸', 'MT': '🇲🇹', 'MU': '🇲🇺', 'MV': '🇲🇻', 'MW': '🇲🇼', 'MX': '🇲🇽', 'MY': '🇲🇾', 'MZ': '🇲🇿', 'NA': '🇳🇦', 'NC': '🇳🇨', 'NE': '🇳🇪', 'NF': '🇳🇫', 'NG': '🇳🇬', 'NI': '🇳🇮', 'NL': '🇳🇱', 'NO': '🇳🇴', 'NP': '🇳🇵', 'NR': '🇳🇷', 'NU': '🇳🇺', 'NZ': '🇳🇿', 'OM': '🇴🇲', 'PA': '🇵🇦', 'PE': '🇵🇪', 'PF': '🇵🇫', 'PG': '🇵🇬', 'PH': '🇵🇭', 'PK': '🇵🇰', 'PL': '🇵🇱', 'PM': '🇵🇲', 'PN': '🇵🇳', 'PR': '🇵🇷', 'PS': '🇵🇸', 'PT': '🇵🇹', 'PW': '🇵🇼', 'PY': '🇵🇾', 'QA': '🇶🇦', 'RE': '🇷🇪', 'RO': '🇷🇴', 'RS': '🇷🇸', 'RU': '🇷🇺', 'RW': '🇷🇼', 'SA': '🇸🇦', 'SB': '🇸🇧', 'SC': '🇸🇨', 'SD': '🇸🇩', 'SE': '🇸🇪', 'SG': '🇸🇬', 'SH': '🇸🇭', 'SI': '🇸🇮', 'SK': '🇸🇰', 'SL': '🇸🇱', 'SM': '🇸🇲', 'SN': '🇸🇳', 'SO': '🇸🇴', 'SR': '🇸🇷', 'SS': '🇸🇸', 'ST': '🇸🇹', 'SV': '🇸🇻', 'SX': '🇸🇽', 'SY': '🇸🇾', 'SZ': '🇸🇿', 'TC': '🇹🇨', 'TD': '🇹🇩', 'TG': '🇹🇬', 'TH': '🇹🇭', 'TJ': '🇹🇯', 'TK': '🇹🇰', 'TL': '🇹🇱', 'TM': '🇹🇲', 'TN': '🇹🇳', 'TO': '🇹🇴', 'TR': '🇹🇷', 'TT': '🇹🇹', 'TV': '🇹🇻', 'TW': '🇹🇼', 'TZ': '🇹🇿', 'UA': '🇺🇦', 'UG': '🇺🇬', 'US': '🇺🇸', 'UY': '🇺🇾', 'UZ': '🇺🇿', 'VA': '🇻🇦', 'VC': '🇻🇨', 'VE': '🇻🇪', 'VG': '🇻🇬', 'VI': '🇻🇮', 'VN': '🇻🇳', 'VU': '🇻🇺', 'WF': '🇼🇫', 'WS': '🇼🇸', 'YE': '🇾🇪', 'YT': '🇾🇹', 'ZA': '🇿🇦', 'ZM': '🇿🇲', 'ZW': '🇿🇼'}
 
 GEOIP_READER = None
-BLOCKED_NETWORKS = []
+
+class RunReport:
+    """Per-run timings and counters. A disabled report ignores every hook, so instrumentation is free by default."""
+    CHAT_FIELDS = ('fetch_seconds', 'messages_scanned', 'links_found', 'links_kept', 'flood_wait_seconds')
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.stages: Dict[str, float] = {}
+        self.chats: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+        self.parse_failures: Dict[str, int] = {}
+        self.outputs: Dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if not self.enabled: yield; return
+        t = time.perf_counter()
+        try: yield
+        finally: self.stages[name] = round(self.stages.get(name, 0) + time.perf_counter() - t, 4)
+
+    def chat(self, chat_id: Any, **values: float):
+        if not self.enabled: return
+        stats = self.chats.setdefault(str(chat_id), dict.fromkeys(self.CHAT_FIELDS, 0))
+        for k, v in values.items(): stats[k] = round(stats.get(k, 0) + v, 4)
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled: self.counters[name] = self.counters.get(name, 0) + n
+
+    def parse_failure(self, protocol: str):
+        if self.enabled: self.parse_failures[protocol] = self.parse_failures.get(protocol, 0) + 1
+
+    def output(self, path: str):
+        if self.enabled and os.path.exists(path): self.outputs[path] = os.path.getsize(path)
+
+    def hit_rate(self, name: str) -> Optional[float]:
+        hits, misses = self.counters.get(f"{name}_hits", 0), self.counters.get(f"{name}_misses", 0)
+        return round(hits / (hits + misses), 4) if hits + misses else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'started': self.started, 'stages': self.stages, 'chats': self.chats, 'counters': self.counters,
+                'cache_hit_rates': {n: self.hit_rate(n) for n in ('dns_cache', 'geoip_cache', 'geoip_table')},
+                'parse_failures': self.parse_failures, 'outputs': self.outputs}
+
+    def write(self, path: str = RUN_REPORT_FILE, prom_path: str = RUN_REPORT_PROM):
+        if not self.enabled: return
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f: json.dump(self.to_dict(), f, indent=2)
+        if prom_path:
+            lines = []
+            def metric(name: str, value, **labels):
+                if value is None: return
+                lbl = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"configjo_{name}{{{lbl}}} {value}" if lbl else f"configjo_{name} {value}")
+            for stage, sec in self.stages.items(): metric('stage_seconds', sec, stage=stage)
+            for chat, stats in self.chats.items():
+                for k, v in stats.items(): metric(f'chat_{k}', v, chat=chat)
+            for k, v in self.counters.items(): metric(k, v)
+            for n in ('dns_cache', 'geoip_cache'): metric(f'{n}_hit_rate', self.hit_rate(n))
+            for proto, v in self.parse_failures.items(): metric('parse_failures', v, protocol=proto)
+            for out, size in self.outputs.items(): metric('output_bytes', size, file=out)
+            os.makedirs(os.path.dirname(prom_path) or '.', exist_ok=True)
+            with open(prom_path, 'w') as f: f.write("\n".join(lines) + "\n")
+
+REPORT = RunReport(enabled=False)
+
+class BlockedIPIndex:
+    """Blocklist compiled into sorted, non-overlapping integer ranges per IP version.
+
+    Lookups are a binary search over the range starts, so the cost of a check does not
+    depend on how many CIDRs `blocked_ips.txt` holds.
+    """
+    def __init__(self, ranges: Optional[Dict[int, List[List[int]]]] = None, digest: str = ""):
+        self.digest = digest
+        self.ranges = {4: [], 6: []}
+        if ranges: self.ranges.update({v: self._merge(r) for v, r in ranges.items()})
+        self._starts = {v: [r[0] for r in rs] for v, rs in self.ranges.items()}
+
+    @staticmethod
+    def _merge(ranges: List[List[int]]) -> List[List[int]]:
+        merged: List[List[int]] = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]: merged[-1][1] = end
+            else: merged.append([start, end])
+        return merged
+
+    @classmethod
+    def from_lines(cls, lines, digest: str = "") -> "BlockedIPIndex":
+        ranges = {4: [], 6: []}
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'): continue
+            try: net = ipaddress.ip_network(line, strict=False)
+            except ValueError: continue
+            ranges[net.version].append([int(net.network_address), int(net.broadcast_address)])
+        return cls(ranges, digest)
+
+    @classmethod
+    def load(cls, path: str = BLOCKED_IPS_FILE, index_path: Optional[str] = BLOCKED_IPS_INDEX_FILE) -> "BlockedIPIndex":
+        """Loads the compiled index if it matches `path`, otherwise compiles (and saves) it."""
+        if not os.path.exists(path): return cls()
+        with open(path, 'rb') as f: data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if index_path and os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f: cached = json.load(f)
+                if cached.get('digest') == digest:
+                    return cls({int(v): r for v, r in cached['ranges'].items()}, digest)
+            except Exception: pass
+        index = cls.from_lines(data.decode('utf-8', errors='ignore').splitlines(), digest)
+        if index_path:
+            try: index.save(index_path)
+            except OSError: pass
+        return index
+
+    def save(self, index_path: str = BLOCKED_IPS_INDEX_FILE):
+        with open(index_path, 'w') as f: json.dump({'digest': self.digest, 'ranges': self.ranges}, f)
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self.ranges.values())
+
+    def contains(self, ip) -> bool:
+        value = int(ip); rs = self.ranges[ip.version]
+        i = bisect.bisect_right(self._starts[ip.version], value) - 1
+        return i >= 0 and value <= rs[i][1]
+
+    def classify(self, hosts) -> Dict[str, bool]:
+        """Batch form of `is_clean_ip`: maps every unique host to whether it is a clean IP."""
+        result: Dict[str, bool] = {}
+        for host in hosts:
+            if host in result: continue
+            try: ip = ipaddress.ip_address(host)
+            except (ValueError, TypeError): result[host] = False; continue
+            result[host] = not (ip.is_loopback or ip.is_link_local or ip.is_multicast or ip.is_unspecified or self.contains(ip))
+        return result
+
+BLOCKED_INDEX = BlockedIPIndex()
 
 def load_ip_data():
     global GEOIP_READER
     try:
-        GEOIP_READER = geoip2.database.Reader(GEOIP_DATABASE_PATH)
+        import geoip2.database, maxminddb
+        # Memory-mapped either way; the C extension when it is installed
+        try: import maxminddb.extension; mode = maxminddb.MODE_MMAP_EXT
+        except ImportError: mode = maxminddb.MODE_MMAP
+        GEOIP_READER = geoip2.database.Reader(GEOIP_DATABASE_PATH, mode=mode)
         print(f"✅ Successfully loaded GeoIP database.")
     except Exception: pass
 
+class CountryTable:
+    """Batch country lookups over a GeoIP reader that learn the network of every answer.
+
+    The database returns the enclosing network with each record. Those ranges go into a sorted
+    table per IP version, so further addresses in a known network are answered with a bisect.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.ranges: Dict[int, Tuple[List[int], List[int], List[str]]] = {4: ([], [], []), 6: ([], [], [])}
+
+    def _find(self, ip) -> Optional[str]:
+        starts, ends, isos = self.ranges[ip.version]
+        i = bisect.bisect_right(starts, int(ip)) - 1
+        return isos[i] if i >= 0 and int(ip) <= ends[i] else None
+
+    def _learn(self, network, iso: str):
+        starts, ends, isos = self.ranges[network.version]
+        i = bisect.bisect_right(starts, int(network.network_address))
+        starts.insert(i, int(network.network_address)); ends.insert(i, int(network.broadcast_address)); isos.insert(i, iso)
+
+    def lookup(self, addrs: Iterable[Optional[str]]) -> Dict[Optional[str], str]:
+        result: Dict[Optional[str], str] = {}
+        for addr in addrs:
+            if addr in result: continue
+            try: ip = ipaddress.ip_address(addr)
+            except ValueError: result[addr] = "N/A"; continue
+            if (iso := self._find(ip)) is not None: REPORT.count('geoip_table_hits'); result[addr] = iso; continue
+            REPORT.count('geoip_table_misses')
+            try: res = self.reader.country(addr)
+            except Exception: result[addr] = "N/A"; continue
+            result[addr] = iso = res.country.iso_code or "N/A"
+            network = getattr(getattr(res, 'traits', None), 'network', None)
+            if network is not None and self._find(network.network_address) is None: self._learn(network, iso)
+        return result
+
 def load_blocked_ips():
-    global BLOCKED_NETWORKS
-    if os.path.exists(BLOCKED_IPS_FILE):
-        try:
-            with open(BLOCKED_IPS_FILE, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        try: BLOCKED_NETWORKS.append(ipaddress.ip_network(line, strict=False))
-                        except ValueError: pass
-        except Exception: pass
+    global BLOCKED_INDEX
+    try: BLOCKED_INDEX = BlockedIPIndex.load(BLOCKED_IPS_FILE, BLOCKED_IPS_INDEX_FILE)
+    except Exception: pass
 
 def is_clean_ip(host: str) -> bool:
+    return BLOCKED_INDEX.classify([host])[host]
+
+async def default_resolver(host: str) -> Optional[str]:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+    return infos[0][4][0] if infos else None
+
+def is_ip_literal(host: str) -> bool:
+    try: ipaddress.ip_address(host); return True
+    except ValueError: return False
+
+def is_loopback(host: Optional[str]) -> bool:
+    if host in ('localhost', '0.0.0.0'): return True
+    try: return ipaddress.ip_address(host).is_loopback
+    except ValueError: return False
+
+class TokenBucket:
+    """Shared rate limiter for Telegram API calls; `pause` stops every caller while a FloodWait is in effect."""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now); self.updated = time.monotonic(); continue
+                if self.rate <= 0: return
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class FetchScheduler:
+    """Runs chat fetches with bounded concurrency, capped retries and a per-run deadline."""
+    def __init__(self, limiter: TokenBucket, concurrency: int = FETCH_CONCURRENCY, max_retries: int = FETCH_MAX_RETRIES,
+                 backoff_cap: float = FETCH_BACKOFF_CAP, deadline: float = FETCH_DEADLINE_SECONDS):
+        self.limiter = limiter
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff_cap = backoff_cap
+        self.deadline = deadline
+        self.flood_seconds = 0
+        self.completed: List[Any] = []
+        self.failed: List[Any] = []
+
+    async def _fetch_with_retry(self, fetch: Callable[[Any, int], Awaitable[None]], chat_id: Any, limit: int, deadline_at: float):
+        from pyrogram.errors import FloodWait
+        for attempt in range(self.max_retries + 1):
+            try:
+                await fetch(chat_id, limit); self.completed.append(chat_id); return
+            except FloodWait as e:
+                wait = e.value + 2; self.flood_seconds += e.value; REPORT.chat(chat_id, flood_wait_seconds=e.value)
+                self.limiter.pause(wait)
+                print(f"   ⏳ FloodWait {e.value}s on {chat_id} (attempt {attempt + 1})")
+                if time.monotonic() + wait > deadline_at: break
+            except Exception as e:
+                wait = min(self.backoff_cap, 2 ** attempt)
+                print(f"   ⚠️ Fetch failed for {chat_id}: {e!r} (attempt {attempt + 1})")
+                if attempt < self.max_retries: await asyncio.sleep(wait)
+        self.failed.append(chat_id)
+
+    async def run(self, jobs: List[Tuple[Any, int]], fetch: Callable[[Any, int], Awaitable[None]]):
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in jobs: queue.put_nowait(job)
+        deadline_at = time.monotonic() + self.deadline
+        async def worker():
+            while not queue.empty():
+                chat_id, limit = queue.get_nowait()
+                await self._fetch_with_retry(fetch, chat_id, limit, deadline_at)
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(jobs)))]
+        done, pending = await asyncio.wait(workers, timeout=self.deadline)
+        for t in pending: t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            print(f"⌛ Fetch deadline ({self.deadline:.0f}s) reached; keeping configs collected so far.")
+        print(f"📡 Fetched {len(self.completed)}/{len(jobs)} chats ({len(self.failed)} failed, {self.flood_seconds}s FloodWait).")
+
+class _HashingFile:
+    """Write-only text file that hashes the UTF-8 bytes on their way to disk."""
+    def __init__(self, raw):
+        self.raw, self.digest, self.size = raw, hashlib.sha256(), 0
+
+    def write(self, text: str):
+        data = text.encode('utf-8')
+        self.digest.update(data); self.size += len(data); self.raw.write(data)
+
+class OutputWriter:
+    """Content-hash gated, atomic file output shared by every emitter (thread safe).
+
+    Content is written to a temp file in the target directory and renamed over the old file, so
+    a crashed run never leaves a truncated subscription. A file whose hash and size match the
+    manifest is left untouched.
+    """
+    def __init__(self, manifest_path: Optional[str] = OUTPUT_MANIFEST):
+        self.manifest_path = manifest_path
+        self.manifest: Dict[str, Dict[str, Any]] = {}
+        self.written: List[str] = []
+        self.unchanged: List[str] = []
+        self._lock = threading.Lock()
+        if manifest_path and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f: self.manifest = json.load(f)
+            except Exception: self.manifest = {}
+        self._saved = dict(self.manifest)
+
+    def _commit(self, path: str, tmp: str, digest: str, size: int) -> bool:
+        entry = {'sha256': digest, 'size': size}
+        with self._lock: same = self.manifest.get(path) == entry and os.path.exists(path) and os.path.getsize(path) == size
+        if same: os.unlink(tmp)
+        else: os.chmod(tmp, 0o644); os.replace(tmp, path)
+        with self._lock:
+            self.manifest[path] = entry
+            (self.unchanged if same else self.written).append(path)
+        return not same
+
+    @contextlib.contextmanager
+    def open(self, path: str):
+        """Streams text into `path`; the hash is taken while writing and decides the final rename."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                f = _HashingFile(raw)
+                yield f
+            self._commit(path, tmp, f.digest.hexdigest(), f.size)
+        except BaseException:
+            if os.path.exists(tmp): os.unlink(tmp)
+            raise
+
+    def write(self, path: str, content: str) -> bool:
+        """Writes `content` unless the manifest already records it; returns True when the file changed."""
+        data = content.encode('utf-8')
+        entry = {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+        with self._lock:
+            if self.manifest.get(path) == entry and os.path.exists(path) and os.path.getsize(path) == len(data):
+                self.unchanged.append(path); return False
+        with self.open(path) as f: f.write(content)
+        return True
+
+    def save(self):
+        """Writes the manifest for the outputs that still exist, sorted and without timestamps."""
+        if not self.manifest_path: return
+        manifest = {p: e for p, e in sorted(self.manifest.items()) if os.path.exists(p)}
+        if manifest != self._saved or not os.path.exists(self.manifest_path):
+            with OutputWriter(None).open(self.manifest_path) as f: f.write(json.dumps(manifest, indent=2))
+
+class RetentionStore:
+    """SQLite store behind the weekly, no-CF and regional histories.
+
+    Entries are keyed per bucket and indexed on their insertion time, so a run only writes the
+    new configs and expiry is a single range delete.
+    """
+    def __init__(self, path: str = RETENTION_DB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries (bucket TEXT NOT NULL, key TEXT NOT NULL, link TEXT NOT NULL, added REAL NOT NULL, PRIMARY KEY (bucket, key)) WITHOUT ROWID")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_added ON entries (bucket, added)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def close(self):
+        """Compacts the file once expired rows leave a quarter of it free, then closes it."""
+        free, pages = (self.conn.execute(f"PRAGMA {p}").fetchone()[0] for p in ("freelist_count", "page_count"))
+        if free * 4 > pages: self.conn.execute("VACUUM")
+        self.conn.close()
+
+    def upsert(self, bucket: str, items: Iterable[Tuple[str, str]], added: float, refresh: bool = False) -> int:
+        """Inserts (key, link) pairs; existing keys keep their first-seen time unless `refresh` is set."""
+        conflict = "DO UPDATE SET link = excluded.link, added = excluded.added" if refresh else "DO NOTHING"
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(f"INSERT INTO entries (bucket, key, link, added) VALUES (?, ?, ?, ?) ON CONFLICT (bucket, key) {conflict}",
+                                  ((bucket, k, link, added) for k, link in items))
+            return self.conn.total_changes - before
+
+    def empty(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM entries LIMIT 1").fetchone() is None
+
+    def expire(self, bucket: str, cutoff: float) -> int:
+        with self.conn:
+            return self.conn.execute("DELETE FROM entries WHERE bucket = ? AND added <= ?", (bucket, cutoff)).rowcount
+
+    def buckets(self, prefix: str = "") -> List[str]:
+        rows = self.conn.execute("SELECT DISTINCT bucket FROM entries WHERE bucket >= ? AND bucket < ?", (prefix, prefix + '\uffff'))
+        return [r[0] for r in rows]
+
+    def links(self, bucket: str) -> Iterable[str]:
+        for (link,) in self.conn.execute("SELECT link FROM entries WHERE bucket = ? ORDER BY link", (bucket,)): yield link
+
+    def export(self, bucket: str, path: str, writer: Optional[OutputWriter] = None) -> int:
+        """Streams the sorted links of a bucket into `path` (newline separated, no trailing newline)."""
+        count = 0
+        with (writer or OutputWriter(None)).open(path) as f:
+            for link in self.links(bucket):
+                if count: f.write("\n")
+                f.write(link); count += 1
+        return count
+
+    def rekey(self, scheme: str, key_for: Callable[[str], str]):
+        """One-time recomputation of every key from its link; rows that collapse keep the earliest entry."""
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'key_scheme'").fetchone()
+        if row and row[0] == scheme: return
+        kept: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        rows = self.conn.execute("SELECT bucket, link, added FROM entries ORDER BY added, link").fetchall()
+        for bucket, link, added in rows: kept.setdefault((bucket, key_for(link)), (link, added))
+        with self.conn:
+            self.conn.execute("DELETE FROM entries")
+            self.conn.executemany("INSERT INTO entries (bucket, key, link, added) VALUES (?, ?, ?, ?)", ((b, k, l, a) for (b, k), (l, a) in kept.items()))
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('key_scheme', ?)", (scheme,))
+        if len(kept) < len(rows): print(f"🗃️ Rekeyed {RETENTION_DB}: {len(rows) - len(kept)} duplicate entries merged.")
+
+def url_protocol(url: str) -> str:
+    """Scheme a link is parsed as, or 'unknown'; the label parse failures are counted under."""
+    scheme, sep, _ = url.partition('://')
+    return scheme if sep and scheme in ('vmess', 'vless', 'trojan', 'ss', 'hysteria2', 'hy2', 'tuic') else 'unknown'
+
+def transport_path(url: str, proto: str) -> Optional[str]:
+    """grpc serviceName, or the path of the other non-ws transports, straight from the link."""
     try:
-        ip = ipaddress.ip_address(host)
-        if ip.is_loopback or ip.is_link_local or ip.is_multicast or ip.is_unspecified: return False
-        for network in BLOCKED_NETWORKS:
-            if ip in network: return False 
-        return True 
-    except ValueError: return False 
+        if proto == 'vmess': return json.loads(base64.b64decode(url[8:] + '=' * 4).decode('utf-8')).get('path') or None
+        q = {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+        return q.get('serviceName') or q.get('path') or None
+    except Exception: return None
+
+class ProxyRecord:
+    """Parsed form of one config URL, produced once and shared read-only by every output stage.
+
+    Output stages never mutate a record; `to_clash` hands out a fresh dict in the same key order
+    the protocol parsers produce.
+    """
+    __slots__ = ('url', 'type', 'name', 'server', 'port', 'uuid', 'password', 'alter_id', 'cipher', 'tls', 'network', 'udp',
+                 'flow', 'fingerprint', 'servername', 'sni', 'skip_cert_verify', 'ws_path', 'ws_host', 'reality_public_key', 'reality_short_id', 'transport_path', 'keys')
+
+    # Clash key -> slot for the scalar fields; ws-opts and reality-opts are rebuilt from their own slots
+    _FIELDS = {'name': 'name', 'type': 'type', 'server': 'server', 'port': 'port', 'uuid': 'uuid', 'password': 'password', 'alterId': 'alter_id',
+               'cipher': 'cipher', 'tls': 'tls', 'network': 'network', 'udp': 'udp', 'flow': 'flow', 'client-fingerprint': 'fingerprint',
+               'servername': 'servername', 'sni': 'sni', 'skip-cert-verify': 'skip_cert_verify'}
+
+    def __init__(self, url: str, proxy: Dict[str, Any]):
+        self.url = url
+        self.keys = tuple(proxy)
+        for key, slot in self._FIELDS.items(): setattr(self, slot, proxy.get(key))
+        ws = proxy.get('ws-opts') or None
+        self.ws_path = ws.get('path') if ws else None
+        self.ws_host = (ws.get('headers') or {}).get('Host') if ws else None
+        reality = proxy.get('reality-opts') or None
+        self.reality_public_key = reality.get('public-key') if reality else None
+        self.reality_short_id = reality.get('short-id') if reality else None
+        for attr in ('servername', 'sni'):
+            value = getattr(self, attr)
+            if isinstance(value, str) and value and re.search(r'[^\w\.\-]', value): setattr(self, attr, self.server)
+        if ws and not self.ws_host: self.ws_host = self.server
+        # grpc serviceName / xhttp, httpupgrade and h2 paths are not Clash fields, but they pick the backend
+        self.transport_path = transport_path(url, self.type) if not ws and self.network not in (None, 'tcp') else None
+
+    @property
+    def credential(self) -> Optional[str]:
+        return self.uuid or self.password
+
+    @property
+    def identity(self) -> str:
+        """Canonical form of the endpoint: protocol, credential, server, port, transport, path and reality key.
+
+        Display names, parameter order, `fp` and a `sni` or ws Host equal to its default do not change
+        it, so reposts of the same server collapse onto one identity.
+        """
+        proto = PROTOCOL_ALIASES.get(self.type, self.type); net = self.network or 'tcp'
+        server = str(self.server).lower(); ws = self.ws_path is not None or self.ws_host
+        path = (self.ws_path or '/') if ws else (self.transport_path or '')
+        # Behind a CDN the ws Host and the SNI choose the backend; missing values count as their defaults
+        host = str(self.ws_host or server).lower() if ws else ''
+        tls = self.type in ('trojan', 'hysteria2', 'tuic') or bool(self.tls)
+        sni = str(self.sni or self.servername or host or server).lower() if tls else ''
+        return f"{proto}://{self.credential}@{server}:{self.port}/{net}{path}?host={host}&sni={sni}#{self.reality_public_key or ''}"
+
+    @property
+    def specificity(self) -> int:
+        """Number of fields the link sets; reposts of one endpoint often drop `flow`, `sid` or `fp`."""
+        return sum(getattr(self, slot) not in (None, '') for slot in self.__slots__ if slot not in ('url', 'name', 'keys'))
+
+    @property
+    def dedup_key(self) -> str:
+        return hashlib.blake2b(self.identity.encode(), digest_size=16).hexdigest()
+
+    def to_clash(self, name: Optional[str] = None) -> Dict[str, Any]:
+        proxy: Dict[str, Any] = {}
+        for key in self.keys:
+            if key == 'ws-opts':
+                proxy[key] = {'path': self.ws_path, 'headers': {'Host': self.ws_host}} if self.ws_path is not None or self.ws_host else None
+            elif key == 'reality-opts':
+                reality = {'public-key': self.reality_public_key} if self.reality_public_key else None
+                if reality and self.reality_short_id: reality['short-id'] = self.reality_short_id
+                proxy[key] = reality
+            else: proxy[key] = getattr(self, self._FIELDS[key])
+        if name is not None: proxy['name'] = name
+        return proxy
+
+def _scan_links(text: str, found: Dict[str, None]) -> List[Tuple[int, int]]:
+    spans = []
+    if '://' not in text: return spans
+    for m in V2RAY_PATTERN.finditer(text):
+        if not (body := LINK_BODY_PATTERN.match(text, m.end())): continue
+        u = text[m.start() : body.end()].strip()
+        if not u.startswith('vmess://') and '#' in u: u = u.split('#')[0]
+        found[u] = None; spans.append((m.start(), body.end()))
+    return spans
+
+def extract_links(text: str, code_spans: Iterable[Tuple[int, int]] = ()) -> List[str]:
+    """Returns the unique config links in a message text, in order of appearance.
+
+    Besides the text itself this scans `code_spans` (offset, length) with whitespace removed and
+    every base64 blob that decodes to something containing a link.
+    """
+    found: Dict[str, None] = {}
+    if not text: return []
+    link_spans = _scan_links(text, found)
+    for offset, length in code_spans:
+        _scan_links(text[offset : offset + length].replace('\n', '').replace(' ', ''), found)
+    for m in BASE64_PATTERN.finditer(text):
+        b64 = m.group()
+        if '=' in b64.rstrip('=') or any(s <= m.start() < e for s, e in link_spans): continue
+        try: raw = base64.b64decode(b64 + '=' * 4)
+        except Exception: continue
+        if b'://' in raw: _scan_links(raw.decode('utf-8', errors='ignore'), found)
+    return list(found)
+
+def extract_message_links(msg) -> List[str]:
+    """`extract_links` for a pyrogram-style message (text or caption plus code/pre entities)."""
+    text = msg.text or msg.caption or ""
+    spans = [(e.offset, e.length) for e in (msg.entities or []) if getattr(e.type, 'name', e.type) in ('CODE', 'PRE')]
+    return extract_links(text, spans)
+
+class Prober:
+    """Concurrent TCP/TLS reachability prober with a rolling per-endpoint history.
+
+    Each sample is `[time, tcp_ms, tls_ms]`; a failed step is null. Endpoints are keyed by what is
+    actually dialled, so configs sharing a server, port and SNI are probed once.
+    """
+    def __init__(self, path: str = PROBE_HISTORY_FILE, concurrency: int = PROBE_CONCURRENCY, timeout: float = PROBE_TIMEOUT, history_size: int = PROBE_HISTORY_SIZE):
+        self.path, self.concurrency, self.timeout, self.history_size = path, concurrency, timeout, history_size
+        self.history: Dict[str, List[List[Any]]] = {}
+        self._ssl = ssl.create_default_context()
+        self._ssl.check_hostname = False; self._ssl.verify_mode = ssl.CERT_NONE
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f: self.history = json.load(f)
+            except Exception: self.history = {}
+
+    @staticmethod
+    def endpoint(rec: ProxyRecord) -> Optional[Tuple[str, str, int, Optional[str]]]:
+        """(key, host, port, sni) for a record, with sni None for plain TCP transports."""
+        if rec.type in PROBE_SKIP_TYPES or not isinstance(rec.server, str) or not isinstance(rec.port, int): return None
+        host = rec.server.lower()
+        if not (rec.type == 'trojan' or rec.tls): return f"tcp://{host}:{rec.port}", host, rec.port, None
+        sni = rec.sni or rec.servername or host
+        return f"tls://{sni}@{host}:{rec.port}", host, rec.port, sni
+
+    async def probe(self, host: str, port: int, sni: Optional[str] = None) -> Tuple[Optional[float], Optional[float]]:
+        """Returns (tcp_ms, tls_ms); tls_ms stays None for plain TCP or when the handshake fails."""
+        loop = asyncio.get_running_loop(); transport = None
+        try:
+            t = loop.time()
+            transport, protocol = await asyncio.wait_for(loop.create_connection(asyncio.Protocol, host, port), self.timeout)
+            tcp = round((loop.time() - t) * 1000, 1)
+            if sni is None: return tcp, None
+            t = loop.time()
+            try:
+                transport = await asyncio.wait_for(loop.start_tls(transport, protocol, self._ssl, server_hostname=None if is_ip_literal(sni) else sni), self.timeout)
+            except (OSError, asyncio.TimeoutError, ValueError): return tcp, None
+            return tcp, round((loop.time() - t) * 1000, 1)
+        except (OSError, asyncio.TimeoutError, ValueError): return None, None
+        finally:
+            if transport: transport.close()
+
+    async def probe_records(self, records: Iterable[ProxyRecord], addresses: Optional[Dict[str, Optional[str]]] = None):
+        """Probes every distinct endpoint once; `addresses` (host -> resolved IP) saves a second DNS lookup."""
+        targets = {}
+        for rec in records:
+            if (ep := self.endpoint(rec)): targets[ep[0]] = ep[1:]
+        sem = asyncio.Semaphore(self.concurrency); now = int(time.time())
+
+        async def run(key: str, host: str, port: int, sni: Optional[str]):
+            async with sem: tcp, tls = await self.probe((addresses or {}).get(host) or host, port, sni)
+            self.history[key] = (self.history.get(key, []) + [[now, tcp, tls]])[-self.history_size:]
+        await asyncio.gather(*(run(k, *t) for k, t in targets.items()))
+        alive = sum(1 for k in targets if self.ok(k, self.history[k][-1]))
+        REPORT.count('probe_reachable', alive); REPORT.count('probe_unreachable', len(targets) - alive)
+        print(f"📶 Probed {len(targets)} endpoints: {alive} reachable.")
+
+    @staticmethod
+    def ok(key: str, sample: List[Any]) -> bool:
+        return sample[1] is not None and (key.startswith('tcp://') or sample[2] is not None)
+
+    def alive(self, rec: ProxyRecord) -> Optional[bool]:
+        """False once the last PROBE_DROP_AFTER samples all failed, None when there is not enough history."""
+        if not (ep := self.endpoint(rec)) or PROBE_DROP_AFTER <= 0: return None
+        samples = self.history.get(ep[0], [])[-PROBE_DROP_AFTER:]
+        if len(samples) < PROBE_DROP_AFTER: return None
+        return any(self.ok(ep[0], s) for s in samples)
+
+    def latency(self, rec: ProxyRecord) -> Optional[float]:
+        """Median connect (+ handshake) time over the successful samples in the window."""
+        if not (ep := self.endpoint(rec)): return None
+        times = sorted(s[1] + (s[2] or 0) for s in self.history.get(ep[0], []) if self.ok(ep[0], s))
+        return times[len(times) // 2] if times else None
+
+    def save(self, max_age_days: int = 7):
+        cutoff = time.time() - max_age_days * 86400
+        self.history = {k: v for k, v in self.history.items() if v and v[-1][0] >= cutoff}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f: json.dump(self.history, f, separators=(',', ':'))
+
+class ConfigPipeline:
+    """Bounded producer/consumer stage that parses and enriches links while chats are still being fetched.
+
+    Fetchers block on `put` when the queue is full, so at most `maxsize` links wait in memory. Results land
+    in the extractor's record and host caches, which `prepare`/`save_files` then read without redoing the work.
+    """
+    def __init__(self, extractor: "V2RayExtractor", maxsize: int = STREAM_QUEUE_SIZE, workers: int = STREAM_WORKERS):
+        self.extractor = extractor
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(max(1, workers))]
+        self.processed = 0
+
+    async def put(self, url: str):
+        await self.queue.put(url)
+
+    async def _worker(self):
+        ext = self.extractor
+        while True:
+            url = await self.queue.get()
+            try:
+                rec = ext.parse_record(url)
+                if rec and isinstance(rec.server, str): await ext.enrich_hosts([rec.server], verbose=False)
+                self.processed += 1
+            except Exception as e: print(f"   ⚠️ Pipeline failed on {url[:40]}…: {e!r}")
+            finally: self.queue.task_done()
+
+    async def close(self):
+        """Waits for the queued links to drain, then stops the workers."""
+        await self.queue.join()
+        for w in self.workers: w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        print(f"🔀 Pipeline processed {self.processed} links while fetching.")
 
 def process_lists():
     ch_list = [ch.strip() for ch in CHANNELS_STR.split(',')] if CHANNELS_STR else []
@@ -104,36 +785,252 @@ def process_lists():
 
 CHANNELS, GROUPS = process_lists()
 
+_POOLS: Dict[int, ProcessPoolExecutor] = {}
+
+def worker_pool(workers: int) -> ProcessPoolExecutor:
+    """The process pool for `workers`, started on first use and reused until exit so each run pays the startup once."""
+    if workers not in _POOLS:
+        # Never fork: `serve` calls this from a running event loop with the pyrogram client threads alive
+        ctx = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        _POOLS[workers] = pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_worker_extractor)
+        atexit.register(pool.shutdown)
+    return _POOLS[workers]
+
+def run_batched(fn: Callable[[List[Any]], List[Any]], items: List[Any], workers: int = PARSE_WORKERS, chunk_size: int = PARSE_CHUNK_SIZE,
+                pool_min: int = PARSE_POOL_MIN) -> List[Any]:
+    """Applies a chunk function across the worker pool, keeping input order; inputs under `pool_min` run in-process.
+
+    Sending records back costs about as much as parsing them, so the pool only wins on tens of thousands of links.
+    """
+    if workers <= 1 or len(items) < pool_min: return fn(items)
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+    return [out for chunk in worker_pool(workers).map(fn, chunks) for out in chunk]
+
+_WORKER_EXTRACTOR: Optional["V2RayExtractor"] = None
+
+def _worker_extractor() -> "V2RayExtractor":
+    """The parser every chunk in a process shares: built once, without a prober or any run state."""
+    global _WORKER_EXTRACTOR
+    if _WORKER_EXTRACTOR is None: _WORKER_EXTRACTOR = V2RayExtractor(probe=False)
+    return _WORKER_EXTRACTOR
+
+def _parse_chunk(urls: List[str]) -> List[Optional["ProxyRecord"]]:
+    ext = _worker_extractor()
+    return [ProxyRecord(u, proxy) if (proxy := ext.parse_config_for_clash(u)) else None for u in urls]
+
 class V2RayExtractor:
-    def __init__(self):
+    def __init__(self, resolver: Optional[Callable[[str], Awaitable[Optional[str]]]] = None, client=None, probe: bool = PROBE_ENABLED):
         self.raw_configs: Set[str] = set()
         self.raw_config_times: Dict[str, datetime.datetime] = {}
-        self.client = Client("my_account", api_id=API_ID, api_hash=API_HASH, session_string=SESSION_STRING)
+        self._client = client
+        self.limiter = TokenBucket(FETCH_RATE)
+        self.resolver = resolver or default_resolver
+        self._dns_cache: Dict[str, Optional[str]] = {}
         self._country_cache: Dict[str, str] = {}
+        self._country_seen: Dict[str, float] = {}
+        self._country_cache_loaded = False
+        self._geo_table: Optional[CountryTable] = None
+        self._records: Dict[str, Optional[ProxyRecord]] = {}
+        self.chat_state: Dict[str, Dict[str, Any]] = {}
+        self._retention: Optional[RetentionStore] = None
+        self.peer_cache: Dict[str, Dict[str, Any]] = {}
+        self.pipeline: Optional[ConfigPipeline] = None
+        self._dns_sem: Optional[asyncio.Semaphore] = None
+        self.prober: Optional[Prober] = Prober() if probe else None
+        self.allow_loopback = ALLOW_LOOPBACK
+
+    @property
+    def retention(self) -> RetentionStore:
+        if self._retention is None:
+            self._retention = RetentionStore(RETENTION_DB)
+            if self._retention.empty(): self.seed_retention(self._retention)
+            self._retention.rekey(RETENTION_KEY_SCHEME, self.retention_key)
+        return self._retention
+
+    @property
+    def client(self):
+        if self._client is None:
+            from pyrogram import Client
+            self._client = Client("my_account", api_id=API_ID, api_hash=API_HASH, session_string=SESSION_STRING)
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    def load_chat_state(self):
+        if os.path.exists(CHAT_STATE_FILE):
+            try:
+                with open(CHAT_STATE_FILE, 'r') as f: self.chat_state = json.load(f)
+            except Exception: self.chat_state = {}
+
+    def save_chat_state(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(CHAT_STATE_FILE, 'w') as f: json.dump(self.chat_state, f)
+
+    @staticmethod
+    def _peer_row(peer) -> Optional[Dict[str, Any]]:
+        kind = type(peer).__name__
+        if kind == 'InputPeerChannel': return {'id': -1000000000000 - peer.channel_id, 'access_hash': peer.access_hash, 'type': 'channel'}
+        if kind == 'InputPeerChat': return {'id': -peer.chat_id, 'access_hash': 0, 'type': 'group'}
+        if kind == 'InputPeerUser': return {'id': peer.user_id, 'access_hash': peer.access_hash, 'type': 'user'}
+        return None
+
+    def peer_id(self, chat_id: Any) -> Any:
+        """Numeric id to use for API calls; configured usernames map to their cached id."""
+        return self.peer_cache.get(str(chat_id), {}).get('id', chat_id)
+
+    async def warm_peers(self, chats: List[Any]):
+        """Loads cached peers into the session and resolves only the configured chats that are not cached.
+
+        Replaces the full `get_dialogs` walk: usernames are resolved one by one, and numeric ids the
+        session cannot resolve are looked up in the dialog list only until all of them are found.
+        """
+        if os.path.exists(PEER_CACHE_FILE) and not self.peer_cache:
+            try:
+                with open(PEER_CACHE_FILE, 'r') as f: self.peer_cache = json.load(f)
+            except Exception: self.peer_cache = {}
+        from pyrogram.errors import FloodWait, PeerIdInvalid, ChannelInvalid
+        storage = self.client.storage; wanted = {str(c) for c in chats}
+        cached = [(k, p) for k, p in self.peer_cache.items() if k in wanted]
+        # (id, access_hash, type, phone_number) rows, plus the configured usernames so `get_chat("@name")` hits the session
+        if cached: await storage.update_peers([(p['id'], p['access_hash'], p['type'], None) for _, p in cached])
+        names = [(p['id'], [k.lstrip('@').lower()]) for k, p in cached if not k.lstrip('-').isdigit()]
+        if names: await storage.update_usernames(names)
+        missing = [c for c in chats if str(c) not in self.peer_cache]
+        unresolved = set()
+        for chat_id in missing:
+            try:
+                await self.limiter.acquire()
+                chat = await self.client.get_chat(chat_id)
+                if (row := self._peer_row(await self.client.resolve_peer(chat.id))): self.peer_cache[str(chat_id)] = row
+            except FloodWait as e: self.limiter.pause(e.value + 2); unresolved.add(chat_id)
+            except (PeerIdInvalid, ChannelInvalid, KeyError, ValueError): unresolved.add(chat_id)
+        if unresolved:
+            await self.limiter.acquire()
+            async for d in self.client.get_dialogs():
+                key = d.chat.id if d.chat.id in unresolved else d.chat.username
+                if key in unresolved:
+                    unresolved.discard(key)
+                    if (row := self._peer_row(await self.client.resolve_peer(d.chat.id))): self.peer_cache[str(key)] = row
+                    if not unresolved: break
+        if missing:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(PEER_CACHE_FILE, 'w') as f: json.dump(self.peer_cache, f)
+        print(f"👥 Peers: {len(chats) - len(missing)} cached, {len(missing) - len(unresolved)} resolved, {len(unresolved)} unknown.")
 
     def get_country_iso_code(self, host: str) -> str:
+        """Reads the host→ISO map built by `enrich_hosts`; only IP literals are looked up on a miss."""
         if not host or not GEOIP_READER: return "N/A"
-        if host in self._country_cache: return self._country_cache[host]
+        if host in self._country_cache: REPORT.count('geoip_cache_hits'); return self._country_cache[host]
+        REPORT.count('geoip_cache_misses')
+        if not is_ip_literal(host): return "N/A"
+        return self.lookup_countries([host])[host]
+
+    def lookup_countries(self, addrs: Iterable[Optional[str]]) -> Dict[Optional[str], str]:
+        if self._geo_table is None or self._geo_table.reader is not GEOIP_READER: self._geo_table = CountryTable(GEOIP_READER)
+        return self._geo_table.lookup(addrs)
+
+    @staticmethod
+    def read_country_cache() -> Dict[str, List[Any]]:
+        """The on-disk `{host: [iso, seen]}` entries still younger than GEOIP_CACHE_TTL_HOURS."""
+        if not os.path.exists(GEOIP_CACHE_FILE): return {}
         try:
-            addr = host
-            try: socket.inet_aton(host)
-            except:
-                try: addr = socket.gethostbyname(host)
-                except: return "N/A"
-            res = GEOIP_READER.country(addr)
-            iso = res.country.iso_code or "N/A"
-            self._country_cache[host] = iso
-            return iso
-        except: return "N/A"
+            with open(GEOIP_CACHE_FILE, 'r') as f: cached = json.load(f)
+        except Exception: return {}
+        cutoff = time.time() - GEOIP_CACHE_TTL_HOURS * 3600
+        return {h: e for h, e in cached.items() if e[1] > cutoff}
+
+    def load_country_cache(self):
+        """Restores the host→ISO results of earlier runs; runs once, before the first enrichment."""
+        self._country_cache_loaded = True
+        for host, (iso, seen) in self.read_country_cache().items():
+            if host not in self._country_cache: self._country_cache[host] = iso; self._country_seen[host] = seen
+
+    def save_country_cache(self):
+        """Merges this run's lookups into the on-disk cache; entries other runs wrote are kept until they expire."""
+        cutoff = time.time() - GEOIP_CACHE_TTL_HOURS * 3600
+        merged = self.read_country_cache()
+        merged.update({h: [self._country_cache[h], t] for h, t in self._country_seen.items() if t > cutoff and h in self._country_cache})
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(GEOIP_CACHE_FILE, 'w') as f: json.dump(merged, f, separators=(',', ':'))
+
+    def expire_caches(self):
+        """For long-running processes: forgets failed DNS lookups and country results past GEOIP_CACHE_TTL_HOURS."""
+        cutoff = time.time() - GEOIP_CACHE_TTL_HOURS * 3600
+        for host in [h for h, addr in self._dns_cache.items() if addr is None]: del self._dns_cache[host]
+        for host in [h for h in self._country_cache if self._country_seen.get(h, 0) <= cutoff]:
+            del self._country_cache[host]; self._country_seen.pop(host, None); self._dns_cache.pop(host, None)
+
+    async def resolve_hosts(self, hosts: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Resolves hostnames concurrently; failures and timeouts are cached as None."""
+        hosts = set(hosts)
+        if self._dns_sem is None: self._dns_sem = asyncio.Semaphore(DNS_CONCURRENCY)
+        async def resolve(host: str):
+            async with self._dns_sem:
+                try: self._dns_cache[host] = await asyncio.wait_for(self.resolver(host), DNS_TIMEOUT)
+                except Exception: self._dns_cache[host] = None
+        pending = []
+        for host in hosts:
+            if host in self._dns_cache: REPORT.count('dns_cache_hits'); continue
+            REPORT.count('dns_cache_misses')
+            if is_ip_literal(host): self._dns_cache[host] = host
+            else: pending.append(resolve(host))
+        if pending: await asyncio.gather(*pending)
+        return {h: self._dns_cache[h] for h in hosts}
+
+    async def enrich_hosts(self, hosts: Iterable[str], verbose: bool = True):
+        """Fills the host→ISO map for every server in one DNS pass and one GeoIP pass."""
+        if not GEOIP_READER: return
+        if not self._country_cache_loaded: self.load_country_cache()
+        hosts = {h for h in hosts if h and h not in self._country_cache}
+        if not hosts: return
+        addrs = await self.resolve_hosts(hosts)
+        countries = self.lookup_countries(addrs.values())
+        now = time.time()
+        for host, addr in addrs.items():
+            self._country_cache[host] = countries[addr]
+            # Unresolved hosts are retried next run instead of being pinned to N/A for the whole TTL
+            if addr is not None: self._country_seen[host] = now
+        if verbose: print(f"🌐 Enriched {len(hosts)} hosts ({sum(a is None for a in addrs.values())} unresolved).")
 
     def parse_config_for_clash(self, url: str) -> Optional[Dict[str, Any]]:
         parsers = {'vmess://': self.parse_vmess, 'vless://': self.parse_vless, 'trojan://': self.parse_trojan, 'ss://': self.parse_shadowsocks, 'hysteria2://': self.parse_hysteria2, 'hy2://': self.parse_hysteria2, 'tuic://': self.parse_tuic}
         for prefix, parser in parsers.items():
             if url.startswith(prefix):
                 try: return parser(url)
-                except: return None
+                except Exception: return None
         return None
 
+    def parse_record(self, url: str) -> Optional[ProxyRecord]:
+        """Memoized parse: every unique URL is decoded once per run."""
+        if url not in self._records:
+            proxy = self.parse_config_for_clash(url)
+            self._records[url] = ProxyRecord(url, proxy) if proxy else None
+            if not proxy: REPORT.parse_failure(url_protocol(url))
+        return self._records[url]
+
+    def parse_batch(self, urls: List[str], workers: int = PARSE_WORKERS, pool_min: int = PARSE_POOL_MIN) -> List[Optional[ProxyRecord]]:
+        """Parses every URL not yet memoized (in worker processes for large batches), in input order."""
+        todo = [u for u in dict.fromkeys(urls) if u not in self._records]
+        for u, rec in zip(todo, run_batched(_parse_chunk, todo, workers, pool_min=pool_min)):
+            # Counted here, in the parent: a worker's REPORT never reaches the run report
+            self._records[u] = rec
+            if rec is None: REPORT.parse_failure(url_protocol(u))
+        return [self._records[u] for u in urls]
+
+    def render_link(self, url: str, rec: ProxyRecord, name: str) -> str:
+        """The subscription link for `url` renamed to `name` (SIP002 for shadowsocks)."""
+        if rec.type == 'ss':
+            return self.generate_sip002_link(rec.to_clash(name)) or f"{url.split('#')[0]}#{name}"
+        try:
+            p_u = list(urlparse(url)); p_u[5] = name; return urlunparse(p_u)
+        except: return f"{url.split('#')[0]}#{name}"
+
+    def render_batch(self, items: List[Tuple[str, ProxyRecord, str]]) -> List[str]:
+        # In-process: renaming is cheaper than shipping the records to a worker and back
+        return [self.render_link(u, rec, name) for u, rec, name in items]
+
     def parse_vmess(self, url: str) -> Optional[Dict[str, Any]]:
         c = json.loads(base64.b64decode(url[8:] + '=' * 4).decode('utf-8'))
         ws_opts = {'path': c.get('path', '/'), 'headers': {'Host': c.get('host', c.get('add'))}} if c.get('net') == 'ws' else None
@@ -190,110 +1087,151 @@ class V2RayExtractor:
             return f"ss://{uinfo}@{proxy['server']}:{proxy['port']}#{proxy.get('name', 'Shadowsocks')}"
         except: return None
 
+    def retention_key(self, link: str) -> str:
+        # Rendered vmess links carry their name after a '#', outside the base64 payload
+        rec = self.parse_record(link) or self.parse_record(link.split('#')[0])
+        return rec.dedup_key if rec else link.split('#')[0]
+
+    def seed_retention(self, store: RetentionStore):
+        """Refills an empty store (first run, or an evicted `.state` cache) from the committed exports.
+
+        The exports hold exactly the links each bucket kept; their windows restart from now.
+        """
+        exports = [('week', WEEKLY_FILE), ('no_cf', OUTPUT_NO_CF)]
+        if os.path.isdir('regions'):
+            exports += [(f"region:{f[5:-4]}", os.path.join('regions', f)) for f in sorted(os.listdir('regions')) if f.startswith('conf-') and f.endswith('.txt')]
+        now = time.time(); seeded = 0
+        for bucket, path in exports:
+            if os.path.exists(path): seeded += store.upsert(bucket, ((self.retention_key(l), l) for l in load_links(path)), now)
+        if seeded: print(f"🗃️ Seeded {RETENTION_DB} with {seeded} links from the published exports.")
+
+    def add_configs(self, urls: Iterable[str], times: Optional[Dict[str, datetime.datetime]] = None) -> List[str]:
+        """Merges links into `raw_configs` keeping the newest message date; returns the links not seen before.
+
+        Nothing is parsed here: reposts of one endpoint are collapsed afterwards, in bulk, by `dedupe`.
+        """
+        added = []
+        for u in urls:
+            if u not in self.raw_configs: self.raw_configs.add(u); added.append(u)
+            if (d := (times or {}).get(u)) and (u not in self.raw_config_times or d > self.raw_config_times[u]): self.raw_config_times[u] = d
+        return added
+
+    def dedupe(self) -> int:
+        """Collapses `raw_configs` to one link per `dedup_key`, parsing through `parse_batch`.
+
+        Of several links for one endpoint the newest repost is kept, then the one setting the most
+        fields, so a stripped copy never replaces one that still carries `flow` or the reality short id;
+        remaining ties go to the smallest string. The survivor inherits the newest message date.
+        Returns the number of links dropped.
+        """
+        ordered = sorted(self.raw_configs); times = self.raw_config_times
+        groups: Dict[str, List[str]] = {}; best: Dict[str, Tuple[Tuple[datetime.datetime, int], str]] = {}
+        for u, rec in zip(ordered, self.parse_batch(ordered)):
+            key = rec.dedup_key if rec else u; rank = (times.get(u) or datetime.datetime.min, rec.specificity if rec else 0)
+            groups.setdefault(key, []).append(u)
+            if key not in best or rank > best[key][0]: best[key] = (rank, u)
+        for key, urls in groups.items():
+            if len(urls) < 2: continue
+            kept = best[key][1]; newest = max((times[u] for u in urls if u in times), default=None)
+            for u in urls:
+                if u != kept: self.raw_configs.discard(u); times.pop(u, None)
+            if newest: times[kept] = newest
+        REPORT.count('duplicate_links', len(ordered) - len(self.raw_configs))
+        return len(ordered) - len(self.raw_configs)
+
+    def configs_from_state(self):
+        """Rebuilds `raw_configs` from the per-chat links in `chat_state`, as a full fetch would have left it."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=CHANNEL_MAX_INACTIVE_DAYS)
+        times: Dict[str, datetime.datetime] = {}
+        for state in self.chat_state.values():
+            for u, d in state.get('links', {}).items():
+                if (d := datetime.datetime.fromisoformat(d)) > cutoff: times[u] = max(times.get(u, d), d)
+        self.raw_configs.clear(); self.raw_config_times.clear()
+        self.add_configs(times, times); self.dedupe()
+        self._records = {u: r for u, r in self._records.items() if u in self.raw_configs}
+
     async def find_raw_configs_from_chat(self, chat_id: int, limit: int):
+        """Reads only messages newer than the stored watermark and merges them with the links cached for the chat."""
         local_configs = set()
         local_times: Dict[str, datetime.datetime] = {}
-        try:
+        state = self.chat_state.get(str(chat_id), {})
+        last_id = state.get('last_id', 0)
+        last_date = datetime.datetime.fromisoformat(state['last_date']) if state.get('last_date') else None
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=CHANNEL_MAX_INACTIVE_DAYS)
+        if not (last_date and last_date > cutoff):
             active = False
-            async for m in self.client.get_chat_history(chat_id, limit=1):
-                if m.date > (datetime.datetime.now() - datetime.timedelta(days=CHANNEL_MAX_INACTIVE_DAYS)): active = True
+            await self.limiter.acquire()
+            async for m in self.client.get_chat_history(self.peer_id(chat_id), limit=1):
+                if m.date > cutoff: active = True
                 break 
             if not active: return
-            async for msg in self.client.get_chat_history(chat_id, limit=limit):
+        newest_id, newest_date = last_id, last_date
+        started, scanned, found = time.perf_counter(), 0, 0
+        await self.limiter.acquire()
+        async for msg in self.client.get_chat_history(self.peer_id(chat_id), limit=limit):
+            if msg.id <= last_id: break
+            scanned += 1
+            if msg.id > newest_id: newest_id, newest_date = msg.id, msg.date or newest_date
+            if len(local_configs) >= MAX_CONFIGS_PER_SOURCE: break
+            for u in extract_message_links(msg):
+                found += 1
+                local_configs.add(u)
+                if msg.date and (u not in local_times or msg.date > local_times[u]):
+                    local_times[u] = msg.date
                 if len(local_configs) >= MAX_CONFIGS_PER_SOURCE: break
-                text = (msg.text or msg.caption or "")
-                texts = [text]
-                if msg.entities:
-                    for e in msg.entities:
-                        if e.type in [enums.MessageEntityType.CODE, enums.MessageEntityType.PRE]:
-                            texts.append(text[e.offset : e.offset + e.length].replace('\n', '').replace(' ', ''))
-                for b64 in BASE64_PATTERN.findall(text):
-                    try: texts.append(base64.b64decode(b64 + '=' * 4).decode('utf-8', errors='ignore'))
-                    except: pass
-                for t in texts:
-                    found = set()
-                    for pattern in V2RAY_PATTERNS: found.update(pattern.findall(t))
-                    for u in found:
-                        u = u.strip()
-                        if not u.startswith('vmess://') and '#' in u: u = u.split('#')[0]
-                        local_configs.add(u)
-                        if msg.date and (u not in local_times or msg.date > local_times[u]):
-                            local_times[u] = msg.date
-                        if len(local_configs) >= MAX_CONFIGS_PER_SOURCE: break
-            res = list(local_configs)[:MAX_CONFIGS_PER_SOURCE]
-            print(f"   ✅ Fetched {len(res)} configs from {chat_id}")
-            self.raw_configs.update(res)
-            for u in res:
-                if u not in self.raw_config_times or local_times.get(u, datetime.datetime.min) > self.raw_config_times[u]:
-                    self.raw_config_times[u] = local_times[u]
-        except FloodWait as e:
-            await asyncio.sleep(e.value + 2); await self.find_raw_configs_from_chat(chat_id, limit)
-
-    def handle_weekly_file(self, new_configs: List[str]):
-        now = datetime.datetime.now(); hist = {}
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r') as f: hist = json.load(f)
-        new_h = {k: v for k, v in hist.items() if datetime.datetime.fromisoformat(v['date']) > (now - datetime.timedelta(days=7))}
-        for c in new_configs:
-            base = c.split('#')[0]
-            if base not in new_h: new_h[base] = {"link": c, "date": now.isoformat()}
-        with open(HISTORY_FILE, 'w') as f: json.dump(new_h, f, indent=2)
-        lns = [v['link'] for v in new_h.values()]
-        with open(WEEKLY_FILE, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(lns)))
-        print(f"📅 7-Day Weekly: Total {len(lns)} configs.")
-
-    def handle_no_cf_retention(self, new_configs: List[str]):
-        now = datetime.datetime.now(); hist = {}
-        if os.path.exists(NO_CF_HISTORY_FILE):
-            with open(NO_CF_HISTORY_FILE, 'r') as f: hist = json.load(f)
-        new_h = {k: v for k, v in hist.items() if datetime.datetime.fromisoformat(v['date']) > (now - datetime.timedelta(hours=72))}
-        for c in new_configs:
-            p = self.parse_config_for_clash(c)
-            if p:
-                uid = str(p.get('uuid') or p.get('password') or c.split('#')[0])
-                if uid not in new_h: new_h[uid] = {"link": c, "date": now.isoformat()}
-        with open(NO_CF_HISTORY_FILE, 'w') as f: json.dump(new_h, f, indent=2)
-        lns = [v['link'] for v in new_h.values()]
-        with open(OUTPUT_NO_CF, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(lns)))
-        print(f"⏱️ 72h Retention: Total {len(lns)} configs.")
-
-    def handle_country_retention(self, country_dict: Dict[str, List[str]]):
-        os.makedirs('regions', exist_ok=True)
-        TARGET_COUNTRIES = ['US', 'UK', 'NL', 'FR', 'DE', 'FI', 'TR'] 
-        HISTORY_FILE_REGION = "regions/country_history.json"
-        now = datetime.datetime.now()
-        hist = {}
-        
-        if os.path.exists(HISTORY_FILE_REGION):
-            try:
-                with open(HISTORY_FILE_REGION, 'r') as f: hist = json.load(f)
-            except: pass
-            
-        new_hist = {}
-        for iso, configs in hist.items():
-            new_hist[iso] = {}
-            for base, data in configs.items():
-                if datetime.datetime.fromisoformat(data['date']) > (now - datetime.timedelta(days=2)):
-                    new_hist[iso][base] = data
+        res = list(local_configs)[:MAX_CONFIGS_PER_SOURCE]
+        cached = sorted(((datetime.datetime.fromisoformat(d), u) for u, d in state.get('links', {}).items() if u not in local_configs), reverse=True)
+        for d, u in cached:
+            if len(res) >= MAX_CONFIGS_PER_SOURCE or d <= cutoff: break
+            res.append(u); local_times[u] = d
+        print(f"   ✅ Fetched {len(res)} configs from {chat_id} ({len(local_configs)} new)")
+        REPORT.chat(chat_id, fetch_seconds=time.perf_counter() - started, messages_scanned=scanned, links_found=found, links_kept=len(res))
+        fresh = self.add_configs(res, local_times)
+        if self.pipeline:
+            for u in fresh: await self.pipeline.put(u)
+        self.chat_state[str(chat_id)] = {
+            'last_id': newest_id, 'last_date': newest_date.isoformat() if newest_date else None,
+            'links': {u: local_times[u].isoformat() for u in res if u in local_times}
+        }
 
+    async def fetch_all(self, jobs: List[Tuple[Any, int]], scheduler: Optional[FetchScheduler] = None):
+        from pyrogram.errors import PeerIdInvalid, ChannelInvalid
+        async def fetch(chat_id: Any, limit: int):
+            try: await self.find_raw_configs_from_chat(chat_id, limit)
+            except (PeerIdInvalid, ChannelInvalid, KeyError):
+                # Stale cache entry: drop it, resolve the chat again and let the scheduler retry
+                if self.peer_cache.pop(str(chat_id), None) is not None: await self.warm_peers([chat_id])
+                raise
+        await (scheduler or FetchScheduler(self.limiter)).run(jobs, fetch)
+
+    def handle_weekly_file(self, new_configs: List[Tuple[str, ProxyRecord]], writer: Optional[OutputWriter] = None):
+        now = time.time(); store = self.retention
+        store.expire('week', now - 7 * 86400)
+        store.upsert('week', ((r.dedup_key, c) for c, r in new_configs), now)
+        total = store.export('week', WEEKLY_FILE, writer)
+        print(f"📅 7-Day Weekly: Total {total} configs.")
+
+    def handle_no_cf_retention(self, new_configs: List[Tuple[str, ProxyRecord]], writer: Optional[OutputWriter] = None):
+        now = time.time(); store = self.retention
+        store.expire('no_cf', now - 72 * 3600)
+        store.upsert('no_cf', ((r.dedup_key, c) for c, r in new_configs), now)
+        total = store.export('no_cf', OUTPUT_NO_CF, writer)
+        print(f"⏱️ 72h Retention: Total {total} configs.")
+
+    def handle_country_retention(self, country_dict: Dict[str, List[Tuple[str, ProxyRecord]]], writer: Optional[OutputWriter] = None):
+        os.makedirs('regions', exist_ok=True)
+        allowed = lambda iso: '*' in REGION_COUNTRIES or iso in REGION_COUNTRIES
+        now = time.time(); store = self.retention
+        for bucket in store.buckets('region:'): store.expire(bucket, now - 2 * 86400)
         for iso, links in country_dict.items():
-            if iso not in TARGET_COUNTRIES: continue
-            if iso not in new_hist: new_hist[iso] = {}
-            for link in links:
-                base = link.split('#')[0]
-                if base not in new_hist[iso]:
-                    new_hist[iso][base] = {"link": link, "date": now.isoformat()}
-                    
-        with open(HISTORY_FILE_REGION, 'w') as f:
-            json.dump(new_hist, f, indent=2)
-            
-        for iso, configs in new_hist.items():
-            final_links = [v['link'] for v in configs.values()]
-            if final_links:
-                with open(f"regions/conf-{iso}.txt", 'w', encoding='utf-8') as f:
-                    f.write("\n".join(sorted(final_links)))
-                    
-        print(f"🌍 Country Subs in 'regions/': Updated {list(new_hist.keys())}")
+            if allowed(iso): store.upsert(f'region:{iso}', ((r.dedup_key, link) for link, r in links), now)
+        updated = []
+        # Files whose bucket expired completely are emptied rather than left with stale links
+        stale = {f[5:-4] for f in os.listdir('regions') if f.startswith('conf-') and f.endswith('.txt')}
+        for iso in sorted(stale | {b.split(':', 1)[1] for b in store.buckets('region:')}):
+            if not allowed(iso): continue
+            store.export(f'region:{iso}', f"regions/conf-{iso}.txt", writer); updated.append(iso)
+        print(f"🌍 Country Subs in 'regions/': Updated {updated}")
 
     def build_pro_config(self, proxies):
         clean_p, clean_n, seen = [], [], set()
@@ -306,11 +1244,6 @@ class V2RayExtractor:
             net = p.get('network', 'tcp')
             if net not in ['tcp', 'ws', 'grpc', 'h2']: p['network'] = 'tcp'
             
-            sni = p.get('servername') or p.get('sni')
-            if sni and re.search(r'[^\w\.\-]', sni): p['servername'] = p['sni'] = p['server']
-            if p.get('ws-opts') and not p['ws-opts']['headers'].get('Host'):
-                p['ws-opts']['headers']['Host'] = p['server']
-            
             if p.get('reality-opts') and len(p['reality-opts'].get('public-key', '')) < 43: continue
             if p.get('network') in ['xhttp', 'httpupgrade']: continue
             
@@ -379,16 +1312,43 @@ class V2RayExtractor:
         tags = [o['tag'] for o in outbounds]
         return {"log": {"level": "warn"}, "dns": {"servers": [{"tag": "dns_proxy", "address": "https://dns.google/dns-query", "detour": "PROXY"}, {"tag": "dns_direct", "address": "1.1.1.1"}], "rules": [{"outbound": "PROXY", "server": "dns_proxy"}, {"rule_set": ["geosite-ir", "geoip-ir"], "server": "dns_direct"}], "final": "dns_direct"}, "inbounds": [{"type": "mixed", "listen": "0.0.0.0", "listen_port": 2080}], "outbounds": [{"type": "direct", "tag": "direct"}, {"type": "block", "tag": "block"}, {"type": "dns", "tag": "dns-out"}, *outbounds, {"type": "selector", "tag": "PROXY", "outbounds": ["auto", *tags]}, {"type": "urltest", "tag": "auto", "outbounds": tags, "url": "http://www.gstatic.com/generate_204", "interval": "5m"}], "route": {"rule_set": [{"tag": "geosite-ir", "type": "remote", "format": "binary", "url": "https://cdn.jsdelivr.net/gh/Chocolate4U/Iran-sing-box-rules@rule-set/geosite-ir.srs", "download_detour": "direct"}, {"tag": "geoip-ir", "type": "remote", "format": "binary", "url": "https://cdn.jsdelivr.net/gh/Chocolate4U/Iran-sing-box-rules@rule-set/geoip-ir.srs", "download_detour": "direct"}], "rules": [{"protocol": "dns", "outbound": "dns-out"}, {"rule_set": ["geosite-ir", "geoip-ir"], "outbound": "direct"}], "final": "PROXY"}}
 
-    def save_files(self):
-        if not self.raw_configs: return
+    def valid_configs(self) -> Set[str]:
         valid_u = set()
         for u in self.raw_configs:
             try:
                 p = urlparse(u)
-                if p.hostname in ['127.0.0.1', 'localhost', '0.0.0.0']: continue
+                if not self.allow_loopback and is_loopback(p.hostname): continue
                 valid_u.add(u)
             except: continue
-            
+        return valid_u
+
+    async def prepare(self, probe: bool = True):
+        """Enrichment stage: resolves and GeoIP-tags every server before `save_files` runs.
+
+        Only fetch/serve runs probe; offline rebuilds rank with the history those runs recorded."""
+        records = [rec for u in self.valid_configs() if (rec := self.parse_record(u))]
+        await self.enrich_hosts({rec.server for rec in records if isinstance(rec.server, str)})
+        if GEOIP_READER: self.save_country_cache()
+        if self.prober and probe:
+            with REPORT.stage('probe'): await self.prober.probe_records(records, self._dns_cache)
+            self.prober.save()
+
+    def rank(self, items: List[Tuple[Any, ProxyRecord]], sort: bool = False) -> List[Tuple[Any, ProxyRecord]]:
+        """Drops (item, record) pairs whose endpoint keeps failing probes and caps the rest to the fastest
+        PROBE_MAX_PER_OUTPUT. The original order is kept unless `sort` asks for latency order."""
+        if not self.prober: return items
+        if PROBE_DROP_AFTER > 0: items = [it for it in items if self.prober.alive(it[1]) is not False]
+        if not (sort or PROBE_MAX_PER_OUTPUT > 0): return items
+        lat = {id(it): self.prober.latency(it[1]) for it in items}
+        fastest = sorted(items, key=lambda it: float('inf') if lat[id(it)] is None else lat[id(it)])
+        if PROBE_MAX_PER_OUTPUT > 0: fastest = fastest[:PROBE_MAX_PER_OUTPUT]
+        if sort: return fastest
+        keep = {id(it) for it in fastest}
+        return [it for it in items if id(it) in keep]
+
+    def assemble(self) -> Dict[str, Any]:
+        """Numbers, names and renders every valid config, and sorts the links into the output groups."""
+        valid_u = self.valid_configs()
         p_list, ren_txt, clean_ip, light_txt = [], [], [], []
         now_utc = datetime.datetime.now(datetime.timezone.utc)
         light_cutoff = now_utc - datetime.timedelta(hours=LIGHT_MAX_AGE_HOURS)
@@ -396,67 +1356,257 @@ class V2RayExtractor:
         def naive_utc(dt: datetime.datetime) -> Optional[datetime.datetime]:
             return dt.replace(tzinfo=None) if dt and dt.tzinfo is not None else dt
         country_links = {} 
+        parsed = []
+        seen: Set[str] = set()
+        with REPORT.stage('render_links'):
+            ordered = sorted(valid_u)
+            for i, (u, rec) in enumerate(zip(ordered, self.parse_batch(ordered)), 1):
+                if not rec: continue
+                srv = rec.server
+                if not srv or (not self.allow_loopback and is_loopback(srv)): continue
+                # raw_configs that skipped `dedupe` may still hold reposts of one endpoint
+                if (key := rec.dedup_key) in seen: continue
+                seen.add(key)
+                iso = self.get_country_iso_code(srv); flag = COUNTRY_FLAGS.get(iso, '🏳️')
+                p_list.append((f"{iso} 💥Config_jo-{i:02d}", rec))
+                parsed.append((u, rec, srv, iso, f"{flag} 💥Config_jo-{i:02d}"))
+            clean_hosts = BLOCKED_INDEX.classify(srv for _, _, srv, _, _ in parsed)
+            finals = self.render_batch([(u, rec, name_f) for u, rec, _, _, name_f in parsed])
         
-        for i, u in enumerate(sorted(list(valid_u)), 1):
-            if not (proxy := self.parse_config_for_clash(u)): continue
-            srv = proxy.get('server')
-            if not srv or srv in ['127.0.0.1', 'localhost', '0.0.0.0']: continue
-            try:
-                if ipaddress.ip_address(srv).is_loopback: continue
-            except: pass
-            
-            iso = self.get_country_iso_code(srv); flag = COUNTRY_FLAGS.get(iso, '🏳️')
-            proxy['name'] = f"{iso} 💥Config_jo-{i:02d}"
-            p_list.append(proxy); name_f = f"{flag} 💥Config_jo-{i:02d}"
-            
-            if proxy['type'] == 'ss':
-                cp = proxy.copy(); cp['name'] = name_f
-                final = self.generate_sip002_link(cp) or f"{u.split('#')[0]}#{name_f}"
-            else:
-                try:
-                    p_u = list(urlparse(u)); p_u[5] = name_f; final = urlunparse(p_u)
-                except: final = f"{u.split('#')[0]}#{name_f}"
-                
-            ren_txt.append(final)
-            msg_date = naive_utc(self.raw_config_times.get(u))
-            if msg_date and msg_date.replace(tzinfo=datetime.timezone.utc) > light_cutoff:
-                light_txt.append(final)
+            for (u, rec, srv, iso, _), final in zip(parsed, finals):
+                ren_txt.append((final, rec))
+                msg_date = naive_utc(self.raw_config_times.get(u))
+                if msg_date and msg_date.replace(tzinfo=datetime.timezone.utc) > light_cutoff:
+                    light_txt.append((final, rec))
             
-            if is_clean_ip(srv): 
-                clean_ip.append(final)
-                if iso and iso != "N/A":
-                    if iso == 'GB': iso = 'UK' 
-                    if iso not in country_links:
-                        country_links[iso] = []
-                    country_links[iso].append(final)
-
-        with open(OUTPUT_ORIGINAL_CONFIGS, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(list(self.raw_configs))))
-        with open(OUTPUT_TXT, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(ren_txt)))
-        with open(OUTPUT_LIGHT, 'w', encoding='utf-8') as f: f.write("\n".join(sorted(light_txt)))
-        print(f"⚡ Light ({LIGHT_MAX_AGE_HOURS}h): {len(light_txt)} configs.")
-        
-        self.handle_no_cf_retention(clean_ip)
-        self.handle_weekly_file(ren_txt)
-        self.handle_country_retention(country_links)
-        
+                if clean_hosts[srv]: 
+                    clean_ip.append((final, rec))
+                    if iso and iso != "N/A":
+                        if iso == 'GB': iso = 'UK' 
+                        if iso not in country_links:
+                            country_links[iso] = []
+                        country_links[iso].append((final, rec))
+
+        # Client-facing outputs skip endpoints that keep failing probes; Config_jo.txt, no_cf and weekly stay complete
+        p_list = self.rank(p_list, sort=PROBE_SORT)
+        light_txt = [final for final, _ in self.rank(light_txt)]
+        country_links = {iso: self.rank(items) for iso, items in country_links.items()}
+        return {'proxies': p_list, 'links': [final for final, _ in ren_txt], 'entries': ren_txt, 'light': light_txt, 'clean': clean_ip, 'countries': country_links}
+
+    def render_clash(self, proxies: List[Tuple[str, ProxyRecord]]) -> str:
+        import yaml
+        c_cfg = self.build_pro_config([r.to_clash(n) for n, r in proxies])
+        # libyaml escapes characters outside the BMP (the emoji in names) as \U escapes; the loaded config is the same
+        return yaml.dump(c_cfg, Dumper=getattr(yaml, 'CDumper', yaml.Dumper), allow_unicode=True, sort_keys=False, indent=2) if c_cfg else ""
+
+    def render_sing_box(self, proxies: List[Tuple[str, ProxyRecord]]) -> str:
+        return json.dumps(self.build_sing_box_config([r.to_clash(n) for n, r in proxies]), ensure_ascii=False, indent=4)
+
+    def write_clash(self, proxies: List[Tuple[str, ProxyRecord]], path: str = OUTPUT_YAML_PRO, writer: Optional[OutputWriter] = None):
+        with REPORT.stage('emit_clash'):
+            if (content := self.render_clash(proxies)): (writer or OutputWriter(None)).write(path, content)
+
+    def write_sing_box(self, proxies: List[Tuple[str, ProxyRecord]], path: str = OUTPUT_JSON_CONFIG_JO, writer: Optional[OutputWriter] = None):
+        with REPORT.stage('emit_singbox'): (writer or OutputWriter(None)).write(path, self.render_sing_box(proxies))
+
+    def save_files(self):
+        if not self.raw_configs: return
+        out = self.assemble()
+        p_list, ren_txt, light_txt, country_links = out['proxies'], out['links'], out['light'], out['countries']
+        writer = OutputWriter()
+
+        # Renders run in the pool while the retention exports (one SQLite connection) stay on this thread
+        with ThreadPoolExecutor(max_workers=EMIT_WORKERS) as pool:
+            jobs = [pool.submit(writer.write, OUTPUT_ORIGINAL_CONFIGS, "\n".join(sorted(self.raw_configs))),
+                    pool.submit(writer.write, OUTPUT_TXT, "\n".join(sorted(ren_txt)))]
+            # Without any message dates (an offline rebuild with no chat state) the Light file is left as it is
+            if self.raw_config_times:
+                jobs.append(pool.submit(writer.write, OUTPUT_LIGHT, "\n".join(sorted(light_txt))))
+                print(f"⚡ Light ({LIGHT_MAX_AGE_HOURS}h): {len(light_txt)} configs.")
+            if p_list: jobs += [pool.submit(self.write_clash, p_list, OUTPUT_YAML_PRO, writer), pool.submit(self.write_sing_box, p_list, OUTPUT_JSON_CONFIG_JO, writer)]
+
+            with REPORT.stage('retention'):
+                self.handle_no_cf_retention(out['clean'], writer)
+                self.handle_weekly_file(out['entries'], writer)
+                self.handle_country_retention(country_links, writer)
+                self.retention.close(); self._retention = None
+            for job in jobs: job.result()
+        writer.save()
         os.makedirs('ruleset', exist_ok=True)
-        if p_list:
-            c_cfg = self.build_pro_config(p_list)
-            if c_cfg:
-                with open(OUTPUT_YAML_PRO, 'w', encoding='utf-8') as f: yaml.dump(c_cfg, f, allow_unicode=True, sort_keys=False, indent=2)
-            with open(OUTPUT_JSON_CONFIG_JO, 'w', encoding='utf-8') as f:
-                json.dump(self.build_sing_box_config(p_list), f, ensure_ascii=False, indent=4)
+        print(f"💾 Outputs: {len(writer.written)} written, {len(writer.unchanged)} unchanged.")
+        for path in [OUTPUT_ORIGINAL_CONFIGS, OUTPUT_TXT, OUTPUT_LIGHT, OUTPUT_NO_CF, WEEKLY_FILE, OUTPUT_YAML_PRO, OUTPUT_JSON_CONFIG_JO, RETENTION_DB]: REPORT.output(path)
+        for iso in country_links: REPORT.output(f"regions/conf-{iso}.txt")
         print(f"⚙️ Total Configs Saved: {len(ren_txt)}")
 
+class LiveFeed:
+    """`serve` mode: applies new messages from the configured chats to an in-memory extractor and
+    flushes the outputs on a debounce.
+
+    `on_message` has pyrogram's handler signature and only needs `chat`, `id`, `date`, `text`/`caption`
+    and `entities` on the message, so tests can drive it with synthetic updates.
+    """
+    def __init__(self, ext: V2RayExtractor, chats: List[Any], debounce: float = SERVE_DEBOUNCE_SECONDS,
+                 max_delay: float = SERVE_MAX_DELAY_SECONDS, interval: float = SERVE_FLUSH_INTERVAL, probe_interval: float = SERVE_PROBE_INTERVAL):
+        self.ext, self.chats = ext, chats
+        self.debounce, self.max_delay, self.interval, self.probe_interval = debounce, max_delay, interval, probe_interval
+        self.dirty = asyncio.Event()
+        self.dirty_since = self.last_update = 0.0
+        self.last_probe: Optional[float] = None
+        self.flushes = 0
+        self.pending: Optional[List[Any]] = None
+
+    def chat_key(self, chat) -> Optional[Any]:
+        """Configured entry (id or username) a message chat belongs to."""
+        for c in self.chats:
+            if str(self.ext.peer_id(c)) == str(chat.id) or str(c) == str(chat.id): return c
+            if getattr(chat, 'username', None) and str(c).lstrip('@').lower() == chat.username.lower(): return c
+        return None
+
+    async def on_message(self, client, message):
+        if (chat := self.chat_key(message.chat)) is None: return
+        # While `start` catches up, applying the message could raise the watermark past unread history
+        if self.pending is not None: self.pending.append(message); return
+        ext = self.ext; links = extract_message_links(message)
+        state = ext.chat_state.setdefault(str(chat), {'last_id': 0, 'last_date': None, 'links': {}})
+        if message.id > state.get('last_id', 0):
+            state['last_id'] = message.id
+            if message.date: state['last_date'] = message.date.isoformat()
+        REPORT.chat(chat, messages_scanned=1, links_found=len(links))
+        if not links: return
+        date = message.date or datetime.datetime.now()
+        for u in links: state['links'][u] = date.isoformat()
+        # Same per-chat cap as a fetch: only the newest MAX_CONFIGS_PER_SOURCE links are kept
+        state['links'] = dict(sorted(state['links'].items(), key=lambda kv: kv[1], reverse=True)[:MAX_CONFIGS_PER_SOURCE])
+        kept = [u for u in links if u in state['links']]
+        for u in ext.add_configs(kept, dict.fromkeys(kept, date)):
+            if ext.pipeline: await ext.pipeline.put(u)
+        REPORT.chat(chat, links_kept=len(kept))
+        self.touch()
+
+    def touch(self):
+        now = asyncio.get_running_loop().time()
+        if not self.dirty.is_set(): self.dirty_since = now; self.dirty.set()
+        self.last_update = now
+
+    async def start(self, client):
+        """Attaches before catching up, so nothing posted meanwhile is missed, then replays what arrived and flushes."""
+        self.pending = []; self.attach(client)
+        try: await catch_up(self.ext)
+        finally: pending, self.pending = self.pending, None
+        for message in pending: await self.on_message(client, message)
+        await self.flush()
+
+    async def flush(self):
+        loop = asyncio.get_running_loop(); ext = self.ext
+        probe = self.last_probe is None or loop.time() - self.last_probe >= self.probe_interval
+        ext.expire_caches(); ext.configs_from_state(); ext.save_chat_state()
+        with REPORT.stage('enrichment'): await ext.prepare(probe=probe)
+        with REPORT.stage('save_files'): ext.save_files()
+        if probe: self.last_probe = loop.time()
+        self.flushes += 1; REPORT.write()
+
+    async def run(self):
+        """Flushes forever: after a quiet debounce (capped at max_delay) once updates arrive, else every interval."""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self.dirty.wait(), self.interval)
+                while (delay := min(self.last_update + self.debounce, self.dirty_since + self.max_delay) - loop.time()) > 0:
+                    await asyncio.sleep(delay)
+            except asyncio.TimeoutError: pass
+            self.dirty.clear()
+            # A failed flush keeps the previous outputs; the next update or interval tries again
+            try: await self.flush()
+            except Exception as e: REPORT.count('flush_errors'); print(f"⚠️ Flush failed: {e!r}")
+
+    def attach(self, client):
+        from pyrogram import filters
+        from pyrogram.handlers import MessageHandler
+        client.add_handler(MessageHandler(self.on_message, filters.chat([self.ext.peer_id(c) for c in self.chats])))
+
+async def catch_up(ext: V2RayExtractor):
+    """One normal fetch of every configured chat, streaming through the pipeline when enabled."""
+    with REPORT.stage('warm_peers'): await ext.warm_peers(CHANNELS + GROUPS)
+    jobs = [(ch, CHANNEL_SEARCH_LIMIT) for ch in CHANNELS] + [(g, GROUP_SEARCH_LIMIT) for g in GROUPS]
+    if STREAM_PIPELINE: ext.pipeline = ConfigPipeline(ext)
+    with REPORT.stage('fetch'):
+        if jobs: await ext.fetch_all(jobs)
+        if ext.pipeline: await ext.pipeline.close(); ext.pipeline = None
+    with REPORT.stage('dedupe'): print(f"🧬 Merged {ext.dedupe()} reposted links into their endpoints.")
+
+async def serve():
+    global REPORT
+    REPORT = RunReport(enabled=bool(RUN_REPORT_FILE or RUN_REPORT_PROM))
+    print("🛰️ Starting config extractor in serve mode..."); load_ip_data(); load_blocked_ips()
+    ext = V2RayExtractor(); ext.load_chat_state()
+    feed = LiveFeed(ext, CHANNELS + GROUPS)
+    async with ext.client:
+        await feed.start(ext.client)
+        if STREAM_PIPELINE: ext.pipeline = ConfigPipeline(ext)
+        print(f"👂 Listening to {len(feed.chats)} chats (debounce {feed.debounce:g}s, interval {feed.interval:g}s).")
+        try: await feed.run()
+        finally:
+            if ext.pipeline: await ext.pipeline.close(); ext.pipeline = None
+            ext.save_chat_state()
+
 async def main():
+    global REPORT
+    REPORT = RunReport(enabled=bool(RUN_REPORT_FILE or RUN_REPORT_PROM))
     print("🚀 Starting config extractor..."); load_ip_data(); load_blocked_ips()
-    ext = V2RayExtractor()
-    async with ext.client:
-        async for d in ext.client.get_dialogs(): pass
-        tasks = [ext.find_raw_configs_from_chat(ch, CHANNEL_SEARCH_LIMIT) for ch in CHANNELS]
-        tasks.extend(ext.find_raw_configs_from_chat(g, GROUP_SEARCH_LIMIT) for g in GROUPS)
-        if tasks: await asyncio.gather(*tasks)
+    ext = V2RayExtractor(); ext.load_chat_state()
+    async with ext.client: await catch_up(ext)
+    ext.save_chat_state()
+    with REPORT.stage('enrichment'): await ext.prepare()
+    with REPORT.stage('save_files'): ext.save_files()
+    REPORT.write()
+
+def load_links(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f: return [l.strip() for l in f if l.strip()]
+
+def offline_extractor(path: str) -> V2RayExtractor:
+    """An extractor seeded from a links file, with message dates restored from the chat state."""
+    ext = V2RayExtractor(); ext.load_chat_state()
+    links = load_links(path); known = set(links)
+    times: Dict[str, datetime.datetime] = {}
+    for state in ext.chat_state.values():
+        for u, d in state.get('links', {}).items():
+            if u in known: times[u] = max(times.get(u, datetime.datetime.min), datetime.datetime.fromisoformat(d))
+    ext.add_configs(links, times); ext.dedupe()
+    return ext
+
+def rebuild(path: str):
+    print(f"🔁 Rebuilding outputs from {path} (offline)..."); load_ip_data(); load_blocked_ips()
+    ext = offline_extractor(path)
+    asyncio.run(ext.prepare(probe=False))
     ext.save_files()
 
+def render(path: str, fmt: str, output: Optional[str]):
+    load_ip_data(); load_blocked_ips()
+    ext = offline_extractor(path)
+    asyncio.run(ext.prepare(probe=False))
+    proxies = ext.assemble()['proxies']
+    if fmt == 'clash': ext.write_clash(proxies, output or OUTPUT_YAML_PRO)
+    else: ext.write_sing_box(proxies, output or OUTPUT_JSON_CONFIG_JO)
+    print(f"🧩 Rendered {len(proxies)} proxies as {fmt} into {output or (OUTPUT_YAML_PRO if fmt == 'clash' else OUTPUT_JSON_CONFIG_JO)}.")
+
+def cli(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Config Jo: extract V2Ray configs from Telegram and build subscriptions.")
+    sub = ap.add_subparsers(dest='command')
+    sub.add_parser('fetch', help="fetch from Telegram and write every output (default)")
+    sub.add_parser('serve', help="stay connected and rewrite the outputs as new messages arrive")
+    p_rebuild = sub.add_parser('rebuild', help="rebuild every output from a links file, without Telegram")
+    p_rebuild.add_argument('--from', dest='source', default=OUTPUT_ORIGINAL_CONFIGS)
+    p_render = sub.add_parser('render', help="render a single client config from a links file, without Telegram")
+    p_render.add_argument('--format', choices=['clash', 'singbox'], required=True)
+    p_render.add_argument('--from', dest='source', default=OUTPUT_ORIGINAL_CONFIGS)
+    p_render.add_argument('--output')
+    args = ap.parse_args(argv)
+
+    if args.command == 'rebuild': rebuild(args.source)
+    elif args.command == 'render': render(args.source, args.format, args.output)
+    elif not all([API_ID, API_HASH, SESSION_STRING]): print(f"❌ API_ID, API_HASH and SESSION_STRING are required for {args.command or 'fetch'}.")
+    elif args.command == 'serve': asyncio.run(serve())
+    else: asyncio.run(main())
+
 if __name__ == "__main__":
-    if all([API_ID, API_HASH, SESSION_STRING]): asyncio.run(main())
+    cli()
@@ -0,0 +1,343 @@
+"""Focused tests for the fetch, enrichment, probe and serve stages.
+
+Everything runs offline against the fakes in `benchmark.py` (or 127.0.0.1 listeners), inside a
+temporary working directory so no committed output or `.state` file is touched.
+
+    python -m pytest -q test_main.py
+"""
+import asyncio
+import datetime
+import shutil
+import ssl
+import subprocess
+import time
+from types import SimpleNamespace
+
+import pytest
+from pyrogram.errors import FloodWait
+
+import benchmark
+import main
+
+VLESS = "vless://11111111-2222-3333-4444-555555555555@{host}:443?security=tls&type=ws&path=%2F"
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'REPORT', main.RunReport(enabled=False))
+    monkeypatch.setattr(main, 'GEOIP_READER', benchmark.StubGeoIP())
+    return tmp_path
+
+
+def message(msg_id: int, text: str, chat_id: int = -1001, username=None) -> SimpleNamespace:
+    return SimpleNamespace(id=msg_id, date=datetime.datetime.now(), text=text, caption=None, entities=None,
+                           chat=SimpleNamespace(id=chat_id, username=username))
+
+
+class FloodingChatClient(benchmark.FakeChatClient):
+    """`FakeChatClient` that raises `FloodWait(seconds)` on the scheduled history calls of a chat."""
+    def __init__(self, histories, floods):
+        super().__init__(histories)
+        self.floods = {chat_id: list(schedule) for chat_id, schedule in floods.items()}
+        self.calls = {}
+
+    async def get_chat_history(self, chat_id, limit: int = 0):
+        n = self.calls[chat_id] = self.calls.get(chat_id, 0) + 1
+        schedule = self.floods.get(chat_id, [])
+        if schedule and schedule[0][0] == n: raise FloodWait(value=schedule.pop(0)[1])
+        async for msg in super().get_chat_history(chat_id, limit): yield msg
+
+
+def histories(chats: int = 3, per_chat: int = 4):
+    return {-1000 - c: [message(per_chat - i, VLESS.format(host=f"h{c}-{i}.example"), -1000 - c) for i in range(per_chat)]
+            for c in range(chats)}
+
+
+# --- FetchScheduler / TokenBucket -------------------------------------------------------------
+
+def test_scheduler_retries_after_scheduled_floodwait():
+    hist = histories()
+    client = FloodingChatClient(hist, {-1000: [(1, 0)], -1002: [(2, 0)]})
+    ext = main.V2RayExtractor(client=client, probe=False); ext.limiter = main.TokenBucket(0)
+    scheduler = main.FetchScheduler(ext.limiter, concurrency=2, max_retries=2, deadline=60)
+    asyncio.run(ext.fetch_all([(c, 10) for c in hist], scheduler))
+    assert sorted(scheduler.completed) == sorted(hist) and not scheduler.failed
+    assert len(ext.raw_configs) == 12
+    assert client.calls[-1000] == 3 and client.calls[-1001] == 2
+
+
+def test_scheduler_gives_up_when_floodwait_passes_the_deadline():
+    hist = histories(chats=1)
+    client = FloodingChatClient(hist, {-1000: [(1, 3600)]})
+    ext = main.V2RayExtractor(client=client, probe=False); ext.limiter = main.TokenBucket(0)
+    scheduler = main.FetchScheduler(ext.limiter, max_retries=3, deadline=30)
+    started = time.monotonic()
+    asyncio.run(ext.fetch_all([(-1000, 10)], scheduler))
+    assert scheduler.failed == [-1000] and not scheduler.completed and not ext.raw_configs
+    assert scheduler.flood_seconds == 3600 and client.calls[-1000] == 1 and time.monotonic() - started < 5
+
+
+def test_token_bucket_rate_and_pause():
+    async def run():
+        bucket = main.TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6): await bucket.acquire()
+        paced = time.monotonic() - started
+        bucket.pause(0.2); started = time.monotonic()
+        await bucket.acquire()
+        return paced, time.monotonic() - started
+    paced, paused = asyncio.run(run())
+    assert paced >= 0.09 and paused >= 0.19
+
+
+# --- pluggable resolver -----------------------------------------------------------------------
+
+def test_enrich_hosts_uses_injected_resolver_and_caches_failures():
+    calls = []
+    async def resolver(host):
+        calls.append(host)
+        if host == 'broken.example': raise OSError("resolver down")
+        return None if host == 'nx.example' else '198.51.100.7'
+    ext = main.V2RayExtractor(resolver=resolver, probe=False)
+    hosts = ['a.example', 'nx.example', 'broken.example', '203.0.113.9']
+    asyncio.run(ext.enrich_hosts(hosts, verbose=False))
+    assert sorted(calls) == ['a.example', 'broken.example', 'nx.example']
+    assert ext._dns_cache == {'a.example': '198.51.100.7', 'nx.example': None, 'broken.example': None, '203.0.113.9': '203.0.113.9'}
+    expected = ext.lookup_countries(['198.51.100.7', None])
+    assert ext.get_country_iso_code('a.example') == expected['198.51.100.7']
+    assert ext.get_country_iso_code('nx.example') == expected[None]
+    assert set(ext._country_seen) == {'a.example', '203.0.113.9'}
+    asyncio.run(ext.enrich_hosts(hosts, verbose=False))
+    assert len(calls) == 3
+    ext.save_country_cache(); ext.expire_caches()
+    assert 'nx.example' not in ext._dns_cache and ext._dns_cache['a.example'] == '198.51.100.7'
+
+
+def test_resolver_timeout_counts_as_unresolved(monkeypatch):
+    monkeypatch.setattr(main, 'DNS_TIMEOUT', 0.05)
+    async def slow(host):
+        await asyncio.sleep(1); return '198.51.100.7'
+    ext = main.V2RayExtractor(resolver=slow, probe=False)
+    assert asyncio.run(ext.resolve_hosts(['slow.example'])) == {'slow.example': None}
+
+
+# --- 127.0.0.1 prober -------------------------------------------------------------------------
+
+async def serve_loopback(tls: ssl.SSLContext = None):
+    """Listener on a free 127.0.0.1 port; the TLS variant completes handshakes with a throwaway cert."""
+    server = await asyncio.start_server(lambda r, w: None, '127.0.0.1', 0, ssl=tls)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def closed_port() -> int:
+    server, port = await serve_loopback()
+    server.close(); await server.wait_closed()
+    return port
+
+
+@pytest.fixture
+def tls_context(tmp_path):
+    if not shutil.which('openssl'): pytest.skip("openssl CLI not available")
+    cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', str(key), '-out', str(cert)], check=True, capture_output=True)
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH); ctx.load_cert_chain(cert, key)
+    return ctx
+
+
+def test_probe_loopback_tcp_tls_and_refused(tls_context):
+    async def run():
+        prober = main.Prober(path=None, timeout=1)
+        plain, plain_port = await serve_loopback()
+        secure, tls_port = await serve_loopback(tls_context)
+        try:
+            return (await prober.probe('127.0.0.1', plain_port), await prober.probe('127.0.0.1', tls_port, 'localhost'),
+                    await prober.probe('127.0.0.1', plain_port, 'localhost'), await prober.probe('127.0.0.1', await closed_port()))
+        finally:
+            for server in (plain, secure): server.close(); await server.wait_closed()
+    tcp_only, tls_ok, tls_on_plain, refused = asyncio.run(run())
+    assert tcp_only[0] is not None and tcp_only[1] is None
+    assert tls_ok[0] is not None and tls_ok[1] is not None
+    assert tls_on_plain[0] is not None and tls_on_plain[1] is None
+    assert refused == (None, None)
+
+
+def test_prepare_probes_loopback_and_rank_drops_dead_endpoints():
+    link = "vless://11111111-2222-3333-4444-555555555555@127.0.0.1:{port}?security=none&type=tcp#{name}"
+    async def run(ext):
+        server, port = await serve_loopback()
+        try:
+            live, dead = link.format(port=port, name='live'), link.format(port=await closed_port(), name='dead')
+            ext.add_configs([live, dead], {})
+            assert not ext.valid_configs()
+            ext.allow_loopback = True
+            for _ in range(main.PROBE_DROP_AFTER): await ext.prepare()
+            return live, dead
+        finally:
+            server.close(); await server.wait_closed()
+    ext = main.V2RayExtractor(probe=True); ext.allow_loopback = False
+    live, dead = asyncio.run(run(ext))
+    assert len(ext.prober.history) == 2
+    ranked = ext.rank([(u, ext.parse_record(u)) for u in (live, dead)])
+    assert [u for u, _ in ranked] == [live]
+    assert ext.prober.latency(ranked[0][1]) is not None
+
+
+# --- batch parsing ------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_parse_batch_reports_failures_from_worker_processes(monkeypatch, workers):
+    monkeypatch.setattr(main, 'REPORT', main.RunReport())
+    good = [VLESS.format(host=f"p{i}.example") for i in range(20)]
+    bad = [f"vmess://not-base64-{i}" for i in range(30)] + ["wireguard://peer@1.2.3.4:51820"]
+    ext = main.V2RayExtractor(probe=False)
+    records = ext.parse_batch(good + bad, workers=workers, pool_min=0)
+    assert [r.server for r in records[:20]] == [f"p{i}.example" for i in range(20)] and not any(records[20:])
+    ext.parse_batch(bad); ext.parse_record(bad[0])
+    assert main.REPORT.parse_failures == {'vmess': 30, 'unknown': 1}
+
+
+# --- endpoint dedupe ----------------------------------------------------------------------------
+
+REALITY = "vless://11111111-2222-3333-4444-555555555555@1.2.3.4:443?{query}"
+PBK = "pbk=SbVKOEMjK0sIlbwg4akyBg5mL5KZwwB-ed4eEE7YnRc&sni=www.amd.com"
+
+
+def test_identity_ignores_defaults_and_keeps_cdn_backends_apart():
+    ext = main.V2RayExtractor(probe=False)
+    key = lambda u: ext.parse_record(u).dedup_key
+    ws = "vless://11111111-2222-3333-4444-555555555555@cdn.example:443?security=tls&type=ws&path=%2Fws{extra}#{name}"
+    assert key(ws.format(extra="", name="a")) == key(ws.format(extra="&sni=cdn.example&fp=chrome&host=cdn.example", name="b"))
+    assert key(ws.format(extra="&host=one.example", name="a")) != key(ws.format(extra="&host=two.example", name="a"))
+    assert key(ws.format(extra="&sni=one.example", name="a")) != key(ws.format(extra="", name="a"))
+    assert key(REALITY.format(query=f"security=reality&{PBK}")) == key(REALITY.format(query=f"type=tcp&security=reality&{PBK}&sid=29b2&fp=chrome&flow=xtls-rprx-vision"))
+
+
+def test_dedupe_keeps_the_repost_that_still_carries_flow_and_short_id():
+    stripped = REALITY.format(query=f"security=reality&{PBK}")
+    full = REALITY.format(query=f"type=tcp&security=reality&{PBK}&sid=29b2&fp=chrome&flow=xtls-rprx-vision")
+    day = datetime.datetime(2026, 1, 1)
+    ext = main.V2RayExtractor(probe=False)
+    ext.add_configs([stripped, full], {stripped: day, full: day})
+    assert ext.dedupe() == 1 and ext.raw_configs == {full}
+    ext = main.V2RayExtractor(probe=False)
+    ext.add_configs([stripped, full], {full: day, stripped: day + datetime.timedelta(hours=1)})
+    assert ext.dedupe() == 1 and ext.raw_configs == {stripped}
+
+
+# --- retention store --------------------------------------------------------------------------
+
+def test_empty_retention_store_is_seeded_from_the_published_exports(workdir):
+    week = [VLESS.format(host=f"w{i}.example") + f"#Config_jo-{i:02d}" for i in range(3)]
+    (workdir / main.WEEKLY_FILE).write_text("\n".join(week), encoding='utf-8')
+    (workdir / 'regions').mkdir(); (workdir / 'regions' / 'conf-DE.txt').write_text(week[0], encoding='utf-8')
+    ext = main.V2RayExtractor(probe=False)
+    store = ext.retention
+    assert (workdir / main.RETENTION_DB).exists() and main.RETENTION_DB.startswith(main.STATE_DIR)
+    assert list(store.links('week')) == sorted(week) and list(store.links('region:DE')) == [week[0]] and not list(store.links('no_cf'))
+    ext.handle_weekly_file([(week[0].replace('#Config_jo-00', '#Config_jo-07'), ext.parse_record(week[0]))])
+    assert len((workdir / main.WEEKLY_FILE).read_text(encoding='utf-8').splitlines()) == 3
+    store.close(); ext._retention = None
+    (workdir / main.WEEKLY_FILE).write_text("", encoding='utf-8')
+    assert list(ext.retention.links('week')) == sorted(week)
+
+
+# --- LiveFeed -----------------------------------------------------------------------------------
+
+def test_on_message_applies_listed_chats_and_keeps_the_newest_links(monkeypatch):
+    monkeypatch.setattr(main, 'MAX_CONFIGS_PER_SOURCE', 3)
+    async def run():
+        ext = main.V2RayExtractor(resolver=benchmark.stub_resolver, probe=False)
+        feed = main.LiveFeed(ext, [-1001, '@FeedChan'])
+        await feed.on_message(None, message(1, VLESS.format(host="other.example"), chat_id=-2002))
+        assert not ext.raw_configs and not ext.chat_state and not feed.dirty.is_set()
+        start = datetime.datetime(2026, 1, 1)
+        for i in range(5):
+            msg = message(i + 1, VLESS.format(host=f"n{i}.example")); msg.date = start + datetime.timedelta(minutes=i)
+            await feed.on_message(None, msg)
+        await feed.on_message(None, message(7, "no links here, just chatter"))
+        await feed.on_message(None, message(3, VLESS.format(host="chan.example"), chat_id=-3003, username="feedchan"))
+        return ext, feed
+    ext, feed = asyncio.run(run())
+    state = ext.chat_state['-1001']
+    assert state['last_id'] == 7
+    assert sorted(state['links']) == sorted(VLESS.format(host=f"n{i}.example") for i in (2, 3, 4))
+    assert list(ext.chat_state['@FeedChan']['links']) == [VLESS.format(host="chan.example")]
+    assert len(ext.raw_configs) == 6 and feed.dirty.is_set()
+
+
+def test_live_feed_flushes_after_debounce_and_survives_a_failed_flush(monkeypatch):
+    monkeypatch.setattr(main, 'REPORT', main.RunReport())
+    async def run():
+        ext = main.V2RayExtractor(resolver=benchmark.stub_resolver, probe=False)
+        feed = main.LiveFeed(ext, [-1001], debounce=0.05, max_delay=1, interval=60)
+        real_save, failures = ext.save_files, [OSError("disk full")]
+        def save_files():
+            if failures: raise failures.pop()
+            real_save()
+        monkeypatch.setattr(ext, 'save_files', save_files)
+        task = asyncio.create_task(feed.run())
+        try:
+            for i in range(2):
+                await feed.on_message(None, message(i + 1, VLESS.format(host=f"live{i}.example")))
+                for _ in range(100):
+                    if feed.flushes > 0 or (i == 0 and main.REPORT.counters.get('flush_errors')): break
+                    await asyncio.sleep(0.05)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return feed
+    feed = asyncio.run(run())
+    assert main.REPORT.counters['flush_errors'] == 1 and feed.flushes == 1
+    with open(main.OUTPUT_ORIGINAL_CONFIGS, encoding='utf-8') as f: saved = f.read()
+    assert "live0.example" in saved and "live1.example" in saved
+
+
+class LiveChatClient(benchmark.FakeChatClient):
+    """`FakeChatClient` with a handler slot: `post` appends a message to a history and delivers it like pyrogram."""
+    def __init__(self, histories):
+        super().__init__(histories)
+        self.handlers, self.during_scan = [], []
+        self.storage = SimpleNamespace(update_peers=self._noop, update_usernames=self._noop)
+
+    @staticmethod
+    async def _noop(rows): pass
+
+    def add_handler(self, handler, group: int = 0): self.handlers.append(handler)
+
+    async def post(self, msg):
+        self.histories[msg.chat.id].insert(0, msg)
+        for handler in self.handlers: await handler.callback(self, msg)
+
+    async def get_chat_history(self, chat_id, limit: int = 0):
+        async for msg in super().get_chat_history(chat_id, limit):
+            yield msg
+            # Posted once the scan has gone past the newest message, so only the handler can see it
+            while limit != 1 and self.during_scan: await self.post(self.during_scan.pop(0))
+
+
+def test_live_feed_start_keeps_messages_posted_during_catch_up_and_first_flush(monkeypatch):
+    monkeypatch.setattr(main, 'CHANNELS', [-1001]); monkeypatch.setattr(main, 'GROUPS', [])
+    hist = {-1001: [message(4 - i, VLESS.format(host=f"old{i}.example")) for i in range(4)]}
+    client = LiveChatClient(hist)
+    client.during_scan.append(message(5, VLESS.format(host="during-catch-up.example")))
+    async def run():
+        ext = main.V2RayExtractor(client=client, resolver=benchmark.stub_resolver, probe=False)
+        ext.peer_cache = {'-1001': {'id': -1001, 'access_hash': 0, 'type': 'channel'}}
+        ext.chat_state = {'-1001': {'last_id': 2, 'last_date': datetime.datetime.now().isoformat(), 'links': {}}}
+        feed = main.LiveFeed(ext, [-1001])
+        real_prepare = ext.prepare
+        async def prepare(probe: bool = True):
+            await client.post(message(6, VLESS.format(host="during-flush.example")))
+            await real_prepare(probe=probe)
+        monkeypatch.setattr(ext, 'prepare', prepare)
+        await feed.start(client)
+        return ext, feed
+    ext, feed = asyncio.run(run())
+    assert len(client.handlers) == 1 and feed.pending is None and feed.flushes == 1
+    state = ext.chat_state['-1001']
+    assert state['last_id'] == 6
+    assert {u.split('@')[1].split(':')[0] for u in state['links']} == {'old0.example', 'old1.example', 'during-catch-up.example', 'during-flush.example'}
+    assert {VLESS.format(host="during-catch-up.example"), VLESS.format(host="during-flush.example")} <= ext.raw_configs
+    with open(main.OUTPUT_ORIGINAL_CONFIGS, encoding='utf-8') as f: assert "during-catch-up.example" in f.read()